@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for the hot paths of the Python side of the bridge.
+
+Runs against simulated YubiKeys, so no hardware is needed and the
+numbers show the time spent in Python (add --latency to include device
+round trips). Results can be saved as a baseline and later runs compared
+against it:
+
+    $ python3 benchmarks/bridge.py --save baseline.json
+    $ python3 benchmarks/bridge.py --baseline baseline.json
+
+The comparison exits with status 1 if a benchmark got slower than the
+threshold allows. Baselines are only comparable on the same machine.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+
+PY_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ykman-gui', 'py')
+sys.path.insert(0, PY_DIR)
+
+import simulated  # noqa: E402
+import yubikey  # noqa: E402
+
+from cryptography import x509  # noqa: E402
+from cryptography.hazmat.backends import default_backend  # noqa: E402
+from cryptography.hazmat.primitives import hashes, serialization  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec, rsa  # noqa: E402
+from OpenSSL import crypto  # noqa: E402
+from ykman.piv import SLOT  # noqa: E402
+
+
+CERT_SLOTS = (
+    SLOT.AUTHENTICATION, SLOT.SIGNATURE, SLOT.KEY_MANAGEMENT, SLOT.CARD_AUTH)
+
+MGM_KEY = simulated.DEFAULT_MGM_KEY.hex()
+P12_PASSWORD = 'password'
+
+# A run is slower than its baseline if its median is more than this many
+# times the baseline median.
+DEFAULT_THRESHOLD = 1.25
+
+
+def measure(func, rounds, setup=None):
+    times = []
+    for i in range(rounds + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        if i > 0:  # The first call is a warm up.
+            times.append(time.perf_counter() - start)
+    return {
+        'rounds': rounds,
+        'median': statistics.median(times),
+        'min': min(times),
+        'mean': statistics.mean(times),
+    }
+
+
+def _controller(backend):
+    # Enumerate every time, so refresh takes the same path as when polling
+    # with an expired descriptor cache.
+    descriptors = yubikey.DescriptorCache(0, backend)
+    controller = yubikey.Controller(descriptors, backend=backend)
+    controller.snapshot()
+    return controller
+
+
+def _write(directory, name, data):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return 'file://' + path
+
+
+def _certificate(key, common_name):
+    name = x509.Name(
+        [x509.NameAttribute(x509.NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.utcnow()
+    return x509.CertificateBuilder() \
+        .public_key(key.public_key()) \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=365)) \
+        .sign(key, hashes.SHA256(), default_backend())
+
+
+def _import_files(directory):
+    # PEM, DER and PKCS#12 files with an EC key and with RSA keys of two
+    # sizes, plus a PEM chain of four certificates.
+    files = {}
+    keys = {
+        'ec256': ec.generate_private_key(ec.SECP256R1(), default_backend()),
+        'rsa1024': rsa.generate_private_key(65537, 1024, default_backend()),
+        'rsa2048': rsa.generate_private_key(65537, 2048, default_backend()),
+    }
+    for name, key in sorted(keys.items()):
+        cert = _certificate(key, 'Benchmark')
+        files['pem_' + name] = _write(
+            directory, name + '.pem',
+            cert.public_bytes(serialization.Encoding.PEM))
+        files['der_' + name] = _write(
+            directory, name + '.der',
+            cert.public_bytes(serialization.Encoding.DER))
+        p12 = crypto.PKCS12()
+        p12.set_certificate(crypto.X509.from_cryptography(cert))
+        p12.set_privatekey(crypto.PKey.from_cryptography_key(key))
+        files['p12_' + name] = _write(
+            directory, name + '.p12', p12.export(P12_PASSWORD.encode()))
+
+    chain = b''.join(
+        simulated.self_signed_certificate('Chain %d' % i)[0].public_bytes(
+            serialization.Encoding.PEM)
+        for i in range(4))
+    files['pem_chain4'] = _write(directory, 'chain4.pem', chain)
+    return files
+
+
+def run(rounds, latency):
+    results = {}
+
+    backend = simulated.SimulatedBackend(devices=1, latency=latency)
+    device = backend.devices[0]
+    controller = _controller(backend)
+
+    results['refresh.cached'] = measure(controller.snapshot, rounds)
+    generation = json.loads(controller.snapshot())['generation']
+    results['refresh.not_modified'] = measure(
+        lambda: controller.snapshot(generation), rounds)
+
+    def forget_device():
+        controller._descriptor = None
+    results['refresh.uncached'] = measure(
+        controller.snapshot, rounds, forget_device)
+
+    certs = [simulated.self_signed_certificate('Slot %d' % i)[0]
+             for i in range(len(CERT_SLOTS))]
+    for n in range(len(CERT_SLOTS) + 1):
+        device.piv.certs = dict(zip(CERT_SLOTS[:n], certs[:n]))
+        results['refresh_piv.certs%d' % n] = measure(
+            controller.refresh_piv, rounds, controller._piv_states.forget)
+    results['refresh_piv.unchanged'] = measure(
+        controller.refresh_piv, rounds)
+
+    results['piv_serialise_cert.cached'] = measure(
+        lambda: yubikey._piv_serialise_cert(CERT_SLOTS[0], certs[0]),
+        rounds)
+    results['piv_serialise_cert.parse'] = measure(
+        lambda: yubikey._piv_cert_summary(certs[0]), rounds)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, url in sorted(_import_files(directory).items()):
+            password = P12_PASSWORD if name.startswith('p12_') else None
+            results['piv_import_file.' + name] = measure(
+                lambda: controller.piv_import_file(
+                    'AUTHENTICATION', url, password, None, MGM_KEY),
+                rounds)
+
+    results['generate_static_pw'] = measure(
+        lambda: controller.generate_static_pw('US'), rounds)
+
+    device.piv.certs = dict(zip(CERT_SLOTS, certs))
+    controller._piv_states.forget()
+    payload = json.loads(controller.refresh_piv())
+    results['as_json.refresh_piv'] = measure(
+        yubikey.as_json(lambda: payload), rounds)
+    results['as_json.bridge_call'] = measure(controller.is_macos, rounds)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        ratio = result['median'] / before['median']
+        result['baseline_ratio'] = ratio
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the bridge against simulated YubiKeys.')
+    parser.add_argument(
+        '-n', '--rounds', type=int, default=50,
+        help='timed calls per benchmark (default: 50)')
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='seconds each simulated device command takes (default: 0)')
+    parser.add_argument(
+        '--save', metavar='FILE',
+        help='write the results as a baseline to FILE')
+    parser.add_argument(
+        '--baseline', metavar='FILE',
+        help='compare the results against a saved baseline')
+    parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help='slowdown versus the baseline that counts as a regression '
+             '(default: %s)' % DEFAULT_THRESHOLD)
+    parser.add_argument(
+        '--json', action='store_true',
+        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = run(args.rounds, args.latency)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': args.latency,
+        'results': results,
+        'regressions': regressions,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        for name, result in sorted(results.items()):
+            ratio = result.get('baseline_ratio')
+            print('{:40} {:10.1f} us {}{}'.format(
+                name, result['median'] * 1e6,
+                '' if ratio is None else '{:6.2f}x'.format(ratio),
+                '  REGRESSION' if name in regressions else ''))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
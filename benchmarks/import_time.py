@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Measures how long the GUI backend takes to start.
+
+Every module is imported in a fresh interpreter, so each measurement
+includes the modules it pulls in itself. The yubikey module is measured
+last: QML waits for it to be imported before any call is made. With
+--refresh the time until the first refresh has returned is measured too.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+PY_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, 'ykman-gui', 'py')
+
+MODULES = (
+    'cryptography.x509',
+    'cryptography.hazmat.primitives.serialization',
+    'fido2.ctap',
+    'smartcard',
+    'ykman.descriptor',
+    'ykman.util',
+    'ykman.piv',
+    'ykman.otp',
+    'ykman.fido',
+    'ykman.scancodes',
+    'yubikey',
+)
+
+IMPORT_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {path!r})
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+'''
+
+REFRESH_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {path!r})
+start = time.perf_counter()
+import yubikey
+yubikey.init()
+yubikey.controller.snapshot()
+print(time.perf_counter() - start)
+'''
+
+
+def _measure(script, rounds):
+    times = []
+    for _ in range(rounds):
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], stderr=subprocess.DEVNULL)
+        times.append(float(output))
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Report the import time of the GUI backend.')
+    parser.add_argument(
+        '-n', '--rounds', type=int, default=5,
+        help='interpreters started per measurement (default: 5)')
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='also measure the time until the first refresh')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    scripts = [(module, IMPORT_SCRIPT.format(path=PY_DIR, module=module))
+               for module in MODULES]
+    if args.refresh:
+        scripts.append(('first refresh', REFRESH_SCRIPT.format(path=PY_DIR)))
+
+    results = {}
+    for name, script in scripts:
+        try:
+            results[name] = _measure(script, args.rounds)
+        except subprocess.CalledProcessError:
+            results[name] = None  # Not installed.
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, seconds in results.items():
+            shown = 'unavailable' if seconds is None else '{:8.1f} ms'.format(
+                seconds * 1000)
+            print('{:48} {}'.format(name, shown))
+
+
+if __name__ == '__main__':
+    main()
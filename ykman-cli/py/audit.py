@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Audit all attached YubiKeys at once.
+
+Every attached key is read in parallel through the same Controller that
+backs the GUI: device info, PIV status and certificates, FIDO PIN state
+and OTP slot status. One JSON record per key is written as soon as the
+key has been read:
+
+    $ python3 ykman-cli/py/audit.py -o audit.jsonl
+    # Keys with a PIV certificate expiring before July, or without a FIDO PIN
+    $ python3 ykman-cli/py/audit.py --expires-before 2025-07-01
+    $ python3 ykman-cli/py/audit.py --where 'fido.has_pin == false'
+
+A --where expression compares the values at a dotted path in the record,
+in which * matches any key, with a JSON value or a string:
+
+    piv.certs.*.validTo < 2025-07-01
+    otp.slots.0 == true
+    dev.version != "5.2.4"
+
+A record matches if any value at the path compares true, empty values
+are never less or greater than anything. Records are only written if
+they match all expressions.
+"""
+
+import argparse
+import json
+import re
+import sys
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from backend import load_yubikey
+
+
+OPERATORS = OrderedDict([
+    ('==', lambda a, b: a == b),
+    ('!=', lambda a, b: a != b),
+    ('<=', lambda a, b: a <= b),
+    ('>=', lambda a, b: a >= b),
+    ('<', lambda a, b: a < b),
+    ('>', lambda a, b: a > b),
+])
+
+_EXPRESSION = re.compile(r'^\s*([\w.*]+)\s*({})\s*(.*?)\s*$'.format(
+    '|'.join(re.escape(op) for op in OPERATORS)))
+
+
+class Filter(object):
+
+    def __init__(self, expression):
+        match = _EXPRESSION.match(expression)
+        if not match:
+            raise ValueError('Invalid filter: ' + expression)
+        path, op, value = match.groups()
+        self.expression = expression
+        self.path = path.split('.')
+        self._compare = OPERATORS[op]
+        self._ordering = op not in ('==', '!=')
+        try:
+            self.value = json.loads(value)
+        except ValueError:
+            self.value = value  # Unquoted strings, like dates.
+
+    def __call__(self, record):
+        for value in _values(record, self.path):
+            if self._ordering and value in (None, ''):
+                continue  # Unknown, e.g. the validTo of a malformed cert.
+            try:
+                if self._compare(value, self.value):
+                    return True
+            except TypeError:
+                continue  # Not comparable, e.g. None and a date.
+        return False
+
+
+def _values(node, path):
+    if not path:
+        yield node
+        return
+    key, rest = path[0], path[1:]
+    if isinstance(node, dict):
+        children = list(node.values()) if key == '*' else \
+            [node[key]] if key in node else []
+    elif isinstance(node, list):
+        if key == '*':
+            children = node
+        elif key.isdigit() and int(key) < len(node):
+            children = [node[int(key)]]
+        else:
+            children = []
+    else:
+        children = []
+    for child in children:
+        for value in _values(child, rest):
+            yield value
+
+
+class Auditor(object):
+
+    def __init__(self, controller, output, filters=()):
+        self._controller = controller
+        self._output = output
+        self._filters = filters
+        self.audited = 0
+        self.matched = 0
+        self.failed = 0
+
+    def run(self, max_workers=None):
+        resp = self._call('refresh_devices')
+        devices = resp.get('devices', [])
+        if not devices:
+            return True
+        with ThreadPoolExecutor(max_workers or len(devices)) as executor:
+            futures = [executor.submit(self._audit, dev) for dev in devices]
+            for future in as_completed(futures):
+                self._report(future.result())
+        return self.failed == 0
+
+    def _call(self, method, *args, **kwargs):
+        return json.loads(getattr(self._controller, method)(*args, **kwargs))
+
+    def _audit(self, dev):
+        serial = dev['serial']
+        started = time.monotonic()
+        record = OrderedDict([('serial', serial), ('dev', dev)])
+        errors = {}
+
+        piv = self._call('refresh_piv', serial=serial)
+        if piv.get('success'):
+            record['piv'] = piv['piv_data']
+        else:
+            errors['piv'] = piv.get('error_id') or piv.get('error_message')
+
+        fido = self._call('fido_has_pin', serial=serial)
+        if fido.get('success'):
+            record['fido'] = {'has_pin': fido['hasPin'], 'pin_retries': None}
+            if fido['hasPin']:
+                retries = self._call('fido_pin_retries', serial=serial)
+                if retries.get('success'):
+                    record['fido']['pin_retries'] = retries['retries']
+                else:
+                    errors['fido'] = retries.get('error_id')
+        else:
+            errors['fido'] = fido.get('error_id') or \
+                fido.get('error_message')
+
+        otp = self._call('slots_status', serial=serial)
+        if otp.get('success'):
+            record['otp'] = {'slots': otp['status']}
+        else:
+            errors['otp'] = otp.get('error_id') or otp.get('error_message')
+
+        record['errors'] = errors
+        record['timing'] = round(time.monotonic() - started, 6)
+        return record
+
+    def _report(self, record):
+        self.audited += 1
+        if record['errors']:
+            self.failed += 1
+        if all(f(record) for f in self._filters):
+            self.matched += 1
+            self._output.write(json.dumps(record) + '\n')
+            self._output.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Audit all attached YubiKeys, one JSON record per key.')
+    parser.add_argument(
+        '-o', '--output',
+        help='write the records to this file instead of stdout')
+    parser.add_argument(
+        '-w', '--where', action='append', default=[], metavar='EXPR',
+        help='only write keys matching EXPR, may be repeated')
+    parser.add_argument(
+        '--expires-before', metavar='DATE',
+        help='only write keys with a PIV certificate valid to before DATE '
+             '(YYYY-MM-DD)')
+    parser.add_argument(
+        '--no-fido-pin', action='store_true',
+        help='only write keys without a FIDO2 PIN')
+    parser.add_argument(
+        '-j', '--workers', type=int,
+        help='number of keys read in parallel (default: all)')
+    parser.add_argument(
+        '-l', '--log-level', default=None,
+        help='enable logging at the given level')
+    parser.add_argument(
+        '--log-file', default=None,
+        help='write the log to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    expressions = list(args.where)
+    if args.expires_before:
+        expressions.append('piv.certs.*.validTo < ' + args.expires_before)
+    if args.no_fido_pin:
+        expressions.append('fido.has_pin == false')
+    try:
+        filters = [Filter(expression) for expression in expressions]
+    except ValueError as e:
+        parser.error(str(e))
+
+    yubikey = load_yubikey()
+    if args.log_level:
+        yubikey.setup_logging(args.log_level, args.log_file)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        auditor = Auditor(yubikey.Controller(), output, filters)
+        ok = auditor.run(args.workers)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    sys.stderr.write('Audited {} keys, {} matched, {} not fully read\n'.format(
+        auditor.audited, auditor.matched, auditor.failed))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+"""Loads the GUI backend for the scripts in this directory."""
+
+import os
+import sys
+
+
+def load_yubikey():
+    try:
+        import yubikey
+    except ImportError:
+        # Running from a source checkout, use the GUI backend next to us.
+        sys.path.append(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            os.pardir, os.pardir, 'ykman-gui', 'py'))
+        import yubikey
+    return yubikey
@@ -1,14 +1,128 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
+import io
+import json
+import shlex
 import sys
+import time
+import traceback
 from ykman.cli.__main__ import main
 
 
+# Given as the first argument, runs many ykman commands in this process,
+# see run_batch.
+BATCH_OPTION = '--batch'
+
+
 def run(argv):
+    if len(argv) > 1 and argv[1] == BATCH_OPTION:
+        return run_batch(argv[0], argv[2:])
+
     sys.argv = argv
 
     try:
         return main()
     except SystemExit as e:
         return e.args[0]
+
+
+def run_batch(prog, args):
+    # Runs one ykman command per line of a file, or stdin, and writes a
+    # JSON record with the exit code, output and duration of each. Lines
+    # are split like a shell would, blank lines and lines starting with #
+    # are skipped.
+    parser = argparse.ArgumentParser(
+        prog=prog + ' ' + BATCH_OPTION,
+        description='Run ykman commands from a file, one per line.')
+    parser.add_argument(
+        'file', nargs='?', default='-',
+        help='file with commands, - for stdin (default)')
+    parser.add_argument(
+        '-k', '--keep-going', action='store_true',
+        help='run the remaining commands after one has failed')
+    try:
+        options = parser.parse_args(args)
+    except SystemExit as e:
+        return e.code
+
+    commands = sys.stdin if options.file == '-' else open(options.file, 'r')
+    try:
+        lines = [(n, line.strip()) for n, line in enumerate(commands, 1)]
+    finally:
+        if commands is not sys.stdin:
+            commands.close()
+
+    out = sys.stdout
+    ran = 0
+    failed = 0
+    started = time.monotonic()
+    for n, line in lines:
+        if not line or line.startswith('#'):
+            continue
+        argv = shlex.split(line)
+        if argv and argv[0] in ('ykman', prog):
+            argv = argv[1:]  # Lines copied from a shell script.
+        record = _run_isolated(prog, argv)
+        record['line'] = n
+        ran += 1
+        out.write(json.dumps(record) + '\n')
+        out.flush()
+        if record['exit_code'] != 0:
+            failed += 1
+            if not options.keep_going:
+                break
+
+    sys.stderr.write('{} commands, {} failed, {:.3f} s in total\n'.format(
+        ran, failed, time.monotonic() - started))
+    return 1 if failed else 0
+
+
+def _run_isolated(prog, argv):
+    # Each command gets empty stdin, so prompts fail instead of reading the
+    # commands that follow, and its own stdout and stderr, which also take
+    # the bytes written by commands exporting to -.
+    stdout = _capture()
+    stderr = _capture()
+    saved = sys.argv, sys.stdin, sys.stdout, sys.stderr
+    sys.argv = [prog] + argv
+    sys.stdin = io.TextIOWrapper(io.BytesIO())
+    sys.stdout, sys.stderr = stdout, stderr
+    start = time.monotonic()
+    try:
+        exit_code = main() or 0
+    except SystemExit as e:
+        exit_code = e.code
+    except Exception:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        duration = time.monotonic() - start
+        sys.argv, sys.stdin, sys.stdout, sys.stderr = saved
+
+    if exit_code is None:
+        exit_code = 0
+    elif not isinstance(exit_code, int):
+        stderr.write(str(exit_code) + '\n')
+        exit_code = 1
+    return {
+        'argv': argv,
+        'exit_code': exit_code,
+        'stdout': _captured(stdout),
+        'stderr': _captured(stderr),
+        'time': round(duration, 6),
+    }
+
+
+def _capture():
+    return io.TextIOWrapper(io.BytesIO(), encoding='utf-8', write_through=True)
+
+
+def _captured(stream):
+    stream.flush()
+    return stream.buffer.getvalue().decode('utf-8', 'replace')
+
+
+if __name__ == '__main__':
+    sys.exit(run(sys.argv))
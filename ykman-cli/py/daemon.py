@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Serve the Controller API over JSON-RPC on a Unix domain socket.
+
+A long-lived process keeps the imports, the device sessions and the
+caches of the GUI backend warm, so scripts do not pay for them on every
+call:
+
+    $ python3 ykman-cli/py/daemon.py serve &
+    $ python3 ykman-cli/py/daemon.py call refresh_devices
+    $ python3 ykman-cli/py/daemon.py call refresh_piv '{"serial": 7654321}'
+
+Requests and responses are JSON-RPC 2.0 objects, one per line. The
+method is any public Controller method, params a list or an object of
+its arguments and the result what the method returns. A batch, an array
+of requests, runs the requests for each device in order and those for
+different devices in parallel. Requests without a serial go to the
+device selected by the last snapshot, and count as requests for its
+serial. Whichever client sends them, calls never use a device at the
+same time: the backend's session pool holds each device for one call,
+or for the whole of an open PIV transaction.
+
+The socket is created readable by the user only, at $YKMAN_GUI_SOCKET
+or ~/.ykman-gui/daemon.sock.
+"""
+
+import argparse
+import inspect
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import load_yubikey
+
+
+SOCKET_ENV = 'YKMAN_GUI_SOCKET'
+SOCKET_PATH = os.path.join(
+    os.path.expanduser('~'), '.ykman-gui', 'daemon.sock')
+
+# Threads running the requests of batches.
+BATCH_WORKERS = 8
+
+# Imported on start, as the backend imports them on first use.
+PRELOAD = (
+    'cryptography.x509',
+    'fido2.ctap',
+    'smartcard',
+    'ykman.piv',
+    'ykman.otp',
+    'ykman.fido',
+)
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RpcError(Exception):
+
+    def __init__(self, code, message):
+        super(RpcError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _error(request_id, code, message):
+    return OrderedDict([
+        ('jsonrpc', '2.0'),
+        ('id', request_id),
+        ('error', {'code': code, 'message': message}),
+    ])
+
+
+class Dispatcher(object):
+    # Runs JSON-RPC requests against a Controller.
+
+    def __init__(self, controller, workers=BATCH_WORKERS):
+        self._controller = controller
+        self._methods = {
+            name: inspect.signature(func)
+            for name, func in inspect.getmembers(
+                type(controller), inspect.isfunction)
+            if not name.startswith('_')}
+        self._executor = ThreadPoolExecutor(workers)
+
+    def handle(self, line):
+        # Returns the response line, or None if there is nothing to send.
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return json.dumps(_error(None, PARSE_ERROR, 'Parse error'))
+        if isinstance(message, list):
+            if not message:
+                return json.dumps(
+                    _error(None, INVALID_REQUEST, 'Empty batch'))
+            responses = [r for r in self._batch(message) if r is not None]
+            return json.dumps(responses) if responses else None
+        response = self._call(message)
+        return None if response is None else json.dumps(response)
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def _batch(self, requests):
+        # Requests for one device run in order on one worker.
+        by_device = OrderedDict()
+        for i, request in enumerate(requests):
+            by_device.setdefault(self._device(request), []).append(i)
+        responses = [None] * len(requests)
+
+        def run(indices):
+            for i in indices:
+                responses[i] = self._call(requests[i])
+        list(self._executor.map(run, by_device.values()))
+        return responses
+
+    def _device(self, request):
+        params = request.get('params') if isinstance(request, dict) else None
+        if isinstance(params, dict) and params.get('serial') is not None:
+            serial = params['serial']
+        else:
+            serial = self._controller.selected_serial
+        return None if serial is None else str(serial)
+
+    def _call(self, request):
+        request_id = request.get('id') if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict) or \
+                    request.get('jsonrpc') != '2.0' or \
+                    not isinstance(request.get('method'), str):
+                raise RpcError(INVALID_REQUEST, 'Invalid request')
+            method = request['method']
+            if method not in self._methods:
+                raise RpcError(METHOD_NOT_FOUND, 'Method not found')
+            params = request.get('params', [])
+            if isinstance(params, list):
+                args, kwargs = params, {}
+            elif isinstance(params, dict):
+                args, kwargs = [], params
+            else:
+                raise RpcError(INVALID_PARAMS, 'Invalid params')
+            try:
+                self._methods[method].bind(self._controller, *args, **kwargs)
+            except TypeError as e:
+                raise RpcError(INVALID_PARAMS, str(e))
+
+            result = getattr(self._controller, method)(*args, **kwargs)
+            if isinstance(result, str):
+                result = json.loads(result)
+        except RpcError as e:
+            return _error(request_id, e.code, e.message)
+        except Exception as e:
+            return _error(request_id, INTERNAL_ERROR, str(e))
+
+        if 'id' not in request:
+            return None  # A notification.
+        return OrderedDict([
+            ('jsonrpc', '2.0'),
+            ('id', request_id),
+            ('result', result),
+        ])
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.dispatcher.handle(line.decode('utf-8'))
+            if response is not None:
+                self.wfile.write(response.encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, dispatcher):
+        self.dispatcher = dispatcher
+        _remove_stale_socket(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self, path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        os.remove(path)  # Left behind by a daemon that is gone.
+        return
+    finally:
+        sock.close()
+    raise RuntimeError('A daemon is already listening on ' + path)
+
+
+class Client(object):
+
+    def __init__(self, path=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path or os.environ.get(SOCKET_ENV) or SOCKET_PATH)
+        self._file = self._sock.makefile('rwb')
+        self._ids = iter(range(1, sys.maxsize))
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def call(self, method, *args, **kwargs):
+        if args and kwargs:
+            raise TypeError('JSON-RPC params are either positional or named')
+        response = self._send(self._request(method, args, kwargs))
+        return _result(response)
+
+    def batch(self, calls):
+        # Takes (method, params) pairs, returns the results in order.
+        requests = [self._request(method, params, {})
+                    if isinstance(params, list)
+                    else self._request(method, (), params)
+                    for method, params in calls]
+        responses = {r['id']: r for r in self._send(requests)}
+        return [_result(responses[r['id']]) for r in requests]
+
+    def _request(self, method, args, kwargs):
+        return {
+            'jsonrpc': '2.0',
+            'id': next(self._ids),
+            'method': method,
+            'params': kwargs if kwargs else list(args),
+        }
+
+    def _send(self, message):
+        self._file.write(json.dumps(message).encode('utf-8') + b'\n')
+        self._file.flush()
+        return json.loads(self._file.readline().decode('utf-8'))
+
+
+def _result(response):
+    if 'error' in response:
+        raise RpcError(response['error']['code'],
+                       response['error']['message'])
+    return response['result']
+
+
+def _preload():
+    for module in PRELOAD:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+
+
+def serve(args):
+    yubikey = load_yubikey()
+    if args.log_level:
+        yubikey.init_with_logging(args.log_level, args.log_file)
+    else:
+        yubikey.init()
+    _preload()
+
+    dispatcher = Dispatcher(yubikey.controller, args.workers)
+    server = Server(args.socket, dispatcher)
+
+    def stop(signum, frame):
+        # shutdown waits for serve_forever, which runs on this thread.
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        dispatcher.shutdown()
+    return 0
+
+
+def call(args):
+    try:
+        params = json.loads(args.params) if args.params else []
+    except ValueError:
+        params = [args.params]  # A single string argument.
+    client = Client(args.socket)
+    try:
+        if isinstance(params, dict):
+            result = client.call(args.method, **params)
+        else:
+            result = client.call(args.method, *params)
+    except RpcError as e:
+        sys.stderr.write('Error {}: {}\n'.format(e.code, e.message))
+        return 1
+    finally:
+        client.close()
+    print(json.dumps(result, indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve the YubiKey Manager backend over JSON-RPC.')
+    parser.add_argument(
+        '-s', '--socket', default=os.environ.get(SOCKET_ENV) or SOCKET_PATH,
+        help='socket path (default: $%s or %s)' % (SOCKET_ENV, SOCKET_PATH))
+    commands = parser.add_subparsers(dest='command')
+
+    serve_parser = commands.add_parser('serve', help='run the daemon')
+    serve_parser.add_argument(
+        '-j', '--workers', type=int, default=BATCH_WORKERS,
+        help='threads running batched requests (default: %d)'
+        % BATCH_WORKERS)
+    serve_parser.add_argument(
+        '-l', '--log-level', default=None,
+        help='enable logging at the given level')
+    serve_parser.add_argument(
+        '--log-file', default=None,
+        help='write the log to this file instead of stdout')
+
+    call_parser = commands.add_parser(
+        'call', help='call a method on a running daemon')
+    call_parser.add_argument('method', help='Controller method')
+    call_parser.add_argument(
+        'params', nargs='?',
+        help='arguments as a JSON array or object')
+    args = parser.parse_args(argv)
+
+    if args.command == 'call':
+        return call(args)
+    if args.command is None:
+        args = parser.parse_args(['--socket', args.socket, 'serve'])
+    return serve(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
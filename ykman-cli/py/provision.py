@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Headless batch provisioning of YubiKeys.
+
+Reads jobs from a JSONL or CSV file (or stdin) and runs them through the
+same Controller that backs the GUI. Each job names a device serial, an
+operation and its arguments:
+
+    {"id": "a1", "serial": 123456, "op": "program_otp",
+     "args": {"slot": 1, "public_id": "...", "private_id": "...",
+              "key": "..."}}
+
+CSV files use the columns id, serial and op, any other non-empty column
+is passed as an argument (lists of applications separated by spaces).
+OTP slots are numbers, PIV slots names:
+
+    id,serial,op,slot,file_url
+    b1,123456,piv_import_file,AUTHENTICATION,alice.p12
+Jobs for one key run in order, different keys run in parallel. One JSON
+result record is written per job as soon as it completes, and --resume
+skips jobs that already succeeded in the output.
+
+With --background-upload, YubiCloud uploads of program_otp jobs are
+queued instead of holding up the key, and one extra record per upload,
+with the URL to finish it at, is written once they are done. Uploads
+still pending at exit are resumed by the next run, see
+ykman-gui/py/upload.py.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import load_yubikey
+
+
+OPERATIONS = (
+    'program_otp',
+    'program_challenge_response',
+    'piv_generate_certificate',
+    'piv_import_file',
+    'piv_import_files',
+    'piv_import_bundle',
+    'write_config',
+)
+
+# Arguments holding file names, the Controller expects them as URLs.
+FILE_ARGS = ('file_url', 'csr_file_url')
+
+# Arguments set by the provisioner, jobs may not pass them.
+RESERVED_ARGS = ('serial', 'background_upload')
+
+
+def _csv_bool(value):
+    return value.strip().lower() in ('1', 'true', 'yes')
+
+
+def _csv_slot(value):
+    value = value.strip()
+    return int(value) if value.isdigit() else value
+
+
+# CSV cells are strings, these arguments are converted before use.
+CSV_TYPES = {
+    'slot': _csv_slot,
+    'touch': _csv_bool,
+    'upload': _csv_bool,
+    'self_sign': _csv_bool,
+    'usb_applications': str.split,
+    'nfc_applications': str.split,
+}
+
+
+def _load_uploader():
+    # Next to the yubikey module, so load_yubikey has set up the path.
+    import upload
+    uploader = upload.from_environment()
+    if uploader.pending():
+        uploader.start()
+    return uploader
+
+
+def read_jobs(stream, fmt):
+    if fmt == 'csv':
+        rows = csv.DictReader(stream)
+    else:
+        rows = (json.loads(line) for line in stream if line.strip())
+
+    for n, row in enumerate(rows, 1):
+        if fmt == 'csv':
+            args = {k: CSV_TYPES.get(k, str)(v) for k, v in row.items()
+                    if k not in ('id', 'serial', 'op') and v not in ('', None)}
+        else:
+            args = row.get('args', {})
+        if not isinstance(args, dict):
+            raise ValueError('Arguments of job {} are not an object'.format(
+                row.get('id') or n))
+        reserved = sorted(set(args) & set(RESERVED_ARGS))
+        if reserved:
+            raise ValueError('Reserved argument on job {}: {}'.format(
+                row.get('id') or n, ', '.join(reserved)))
+        job = {
+            'id': str(row.get('id') or n),
+            'serial': int(row['serial']),
+            'op': row['op'],
+            'args': args,
+        }
+        if job['op'] not in OPERATIONS:
+            raise ValueError('Unsupported operation on job {}: {}'.format(
+                job['id'], job['op']))
+        yield job
+
+
+def read_completed(path):
+    completed = set()
+    if path and os.path.isfile(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Partially written line from an aborted run.
+                if record.get('success'):
+                    completed.add(record['id'])
+    return completed
+
+
+def _file_url(path):
+    if urllib.parse.urlparse(path).scheme == 'file':
+        return path
+    return 'file:' + urllib.request.pathname2url(os.path.abspath(path))
+
+
+class Provisioner(object):
+
+    def __init__(self, controller, output, keep_going=False,
+                 background_upload=False):
+        self._controller = controller
+        self._output = output
+        self._keep_going = keep_going
+        self._background_upload = background_upload
+        self._lock = threading.Lock()
+        self.uploads = []
+
+    def run(self, jobs, max_workers=None):
+        by_serial = OrderedDict()
+        for job in jobs:
+            job['queued'] = time.monotonic()
+            by_serial.setdefault(job['serial'], []).append(job)
+        if not by_serial:
+            return True
+
+        attached = self._attached_serials()
+        workers = max_workers or len(by_serial)
+        with ThreadPoolExecutor(workers) as executor:
+            results = executor.map(
+                lambda item: self._run_key(item[0], item[1], attached),
+                by_serial.items())
+            return all(list(results))
+
+    def _attached_serials(self):
+        resp = json.loads(self._controller.refresh_devices())
+        return {dev['serial'] for dev in resp.get('devices', [])}
+
+    def _run_key(self, serial, jobs, attached):
+        ok = True
+        for job in jobs:
+            started = time.monotonic()
+            if serial not in attached:
+                result = {'success': False, 'error_id': 'device_not_found'}
+            elif not ok and not self._keep_going:
+                result = {'success': False, 'error_id': 'skipped'}
+            else:
+                try:
+                    result = self._execute(job)
+                except Exception as e:
+                    # E.g. arguments the operation does not take.
+                    result = {
+                        'success': False,
+                        'error_id': None,
+                        'error_message': str(e),
+                    }
+            finished = time.monotonic()
+            ok = ok and result.get('success', False)
+
+            record = OrderedDict([
+                ('id', job['id']),
+                ('serial', serial),
+                ('op', job['op']),
+            ])
+            record.update(result)
+            record['timing'] = {
+                'wait': round(started - job['queued'], 6),
+                'execute': round(finished - started, 6),
+            }
+            self._write(record)
+            if result.get('upload_id'):
+                with self._lock:
+                    self.uploads.append(
+                        (job['id'], serial, result['upload_id']))
+        return ok
+
+    def report_uploads(self, uploader, timeout=None):
+        # Waits for the queued uploads and writes a record for each.
+        uploader.wait([upload_id for _, _, upload_id in self.uploads],
+                      timeout)
+        ok = True
+        for job_id, serial, upload_id in self.uploads:
+            upload = uploader.get(upload_id)
+            record = OrderedDict([
+                ('id', job_id),
+                ('serial', serial),
+                ('op', 'upload'),
+                ('success', upload['state'] == 'done'),
+                ('upload_id', upload_id),
+                ('state', upload['state']),
+                ('finish_url', upload['finish_url']),
+                ('upload_errors', upload['errors']),
+            ])
+            ok = ok and record['success']
+            self._write(record)
+        return ok
+
+    def _execute(self, job):
+        args = dict(job['args'])
+        if self._background_upload and job['op'] == 'program_otp':
+            args['background_upload'] = True
+        for name in FILE_ARGS:
+            if args.get(name):
+                args[name] = _file_url(args[name])
+        if args.get('files'):
+            args['files'] = {slot: _file_url(path)
+                             for slot, path in args['files'].items()}
+        method = getattr(self._controller, job['op'])
+        result = json.loads(method(serial=job['serial'], **args))
+        if not isinstance(result, dict):
+            result = {'success': True, 'result': result}
+        return result
+
+    def _write(self, record):
+        with self._lock:
+            self._output.write(json.dumps(record) + '\n')
+            self._output.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Provision YubiKeys from a file of jobs.')
+    parser.add_argument(
+        'jobs', nargs='?', default='-',
+        help='JSONL or CSV file with jobs, - for stdin (default)')
+    parser.add_argument(
+        '-f', '--format', choices=('jsonl', 'csv'),
+        help='job file format, guessed from the file name if not given')
+    parser.add_argument(
+        '-o', '--output',
+        help='append result records to this file instead of stdout')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='skip jobs that already succeeded according to --output')
+    parser.add_argument(
+        '--keep-going', action='store_true',
+        help='continue with the next job for a key after a failure')
+    parser.add_argument(
+        '-j', '--workers', type=int,
+        help='number of keys provisioned in parallel (default: all)')
+    parser.add_argument(
+        '--background-upload', action='store_true',
+        help='queue YubiCloud uploads instead of waiting for each')
+    parser.add_argument(
+        '--upload-timeout', type=float, default=60.0,
+        help='seconds to wait for queued uploads at the end (default: 60)')
+    parser.add_argument(
+        '-l', '--log-level', default=None,
+        help='enable logging at the given level')
+    parser.add_argument(
+        '--log-file', default=None,
+        help='write the log to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    if args.resume and not args.output:
+        parser.error('--resume requires --output')
+
+    fmt = args.format or (
+        'csv' if args.jobs.lower().endswith('.csv') else 'jsonl')
+
+    yubikey = load_yubikey()
+    if args.log_level:
+        yubikey.setup_logging(args.log_level, args.log_file)
+
+    completed = read_completed(args.output) if args.resume else set()
+    jobs_file = sys.stdin if args.jobs == '-' else open(args.jobs, 'r')
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        try:
+            jobs = [job for job in read_jobs(jobs_file, fmt)
+                    if job['id'] not in completed]
+        except (ValueError, KeyError) as e:
+            parser.error('Invalid job file: {}'.format(e))
+        uploader = _load_uploader() if args.background_upload else None
+        provisioner = Provisioner(
+            yubikey.Controller(uploader=uploader), output, args.keep_going,
+            args.background_upload)
+        ok = provisioner.run(jobs, args.workers)
+        if provisioner.uploads:
+            ok = provisioner.report_uploads(
+                uploader, args.upload_timeout) and ok
+        return 0 if ok else 1
+    finally:
+        if jobs_file is not sys.stdin:
+            jobs_file.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
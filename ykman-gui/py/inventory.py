@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""An on-disk inventory of the YubiKeys the backend has seen.
+
+The last device info, PIV certificates and status, OTP slot status and
+FIDO PIN state read from each key are kept in an SQLite database, keyed
+by serial and timestamped per section. The GUI shows the remembered
+state of a key while it is read again, and scripts can look up keys
+without touching them:
+
+    $ export YKMAN_GUI_INVENTORY=~/.ykman-gui/inventory.sqlite
+    $ python3 ykman-gui/py/inventory.py
+    $ python3 ykman-gui/py/inventory.py --serial 7654321
+
+Nothing is remembered unless YKMAN_GUI_INVENTORY names the database.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+INVENTORY_ENV = 'YKMAN_GUI_INVENTORY'
+
+SECTIONS = ('dev_info', 'piv', 'otp', 'fido')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS devices (
+    serial INTEGER PRIMARY KEY,
+    fingerprint TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS devices_fingerprint ON devices (fingerprint);
+CREATE TABLE IF NOT EXISTS sections (
+    serial INTEGER NOT NULL REFERENCES devices (serial),
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (serial, name)
+);
+'''
+
+
+def from_environment():
+    # None unless an inventory has been asked for.
+    path = os.environ.get(INVENTORY_ENV)
+    return Inventory(path) if path else None
+
+
+class Inventory(object):
+
+    def __init__(self, path):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)),
+                        exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        # What was last written, to skip writes that change nothing.
+        self._written = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def seen(self, serial, fingerprint=None):
+        now = time.time()
+        with self._lock, self._db:
+            self._touch(serial, now)
+            if fingerprint is not None:
+                # A fingerprint belongs to the key last seen with it.
+                self._db.execute(
+                    'UPDATE devices SET fingerprint = NULL '
+                    'WHERE fingerprint = ? AND serial != ?',
+                    (fingerprint, serial))
+                self._db.execute(
+                    'UPDATE devices SET fingerprint = ? WHERE serial = ?',
+                    (fingerprint, serial))
+
+    def update(self, serial, section, values):
+        # Merges values into what is remembered for the section.
+        if section not in SECTIONS:
+            raise ValueError('Unknown section: ' + section)
+        with self._lock:
+            current = self._written.get((serial, section))
+            if current is None:
+                current = self._read_section(serial, section) or {}
+            data = dict(current, **values)
+            if data == current and (serial, section) in self._written:
+                return
+            now = time.time()
+            with self._db:
+                self._touch(serial, now)
+                self._db.execute(
+                    'INSERT OR REPLACE INTO sections '
+                    '(serial, name, data, updated) VALUES (?, ?, ?, ?)',
+                    (serial, section, json.dumps(data, sort_keys=True), now))
+            self._written[(serial, section)] = data
+
+    def get(self, serial):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT serial, fingerprint, first_seen, last_seen '
+                'FROM devices WHERE serial = ?', (serial,)).fetchone()
+            return None if row is None else self._entry(row)
+
+    def find(self, fingerprint):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT serial, fingerprint, first_seen, last_seen '
+                'FROM devices WHERE fingerprint = ?',
+                (fingerprint,)).fetchone()
+            return None if row is None else self._entry(row)
+
+    def list(self):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT serial, fingerprint, first_seen, last_seen '
+                'FROM devices ORDER BY serial').fetchall()
+            return [self._entry(row) for row in rows]
+
+    def _touch(self, serial, now):
+        self._db.execute(
+            'INSERT OR IGNORE INTO devices (serial, first_seen, last_seen) '
+            'VALUES (?, ?, ?)', (serial, now, now))
+        self._db.execute(
+            'UPDATE devices SET last_seen = ? WHERE serial = ?',
+            (now, serial))
+
+    def _read_section(self, serial, section):
+        row = self._db.execute(
+            'SELECT data FROM sections WHERE serial = ? AND name = ?',
+            (serial, section)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _entry(self, row):
+        serial, fingerprint, first_seen, last_seen = row
+        entry = {
+            'serial': serial,
+            'fingerprint': fingerprint,
+            'first_seen': first_seen,
+            'last_seen': last_seen,
+        }
+        for name, data, updated in self._db.execute(
+                'SELECT name, data, updated FROM sections WHERE serial = ?',
+                (serial,)):
+            entry[name] = json.loads(data)
+            entry[name + '_updated'] = updated
+        return entry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Print the remembered state of YubiKeys as JSONL.')
+    parser.add_argument(
+        '--serial', type=int, action='append',
+        help='only print this key, may be repeated')
+    parser.add_argument(
+        '--database', default=None,
+        help='inventory database (default: $%s)' % INVENTORY_ENV)
+    args = parser.parse_args(argv)
+
+    path = args.database or os.environ.get(INVENTORY_ENV)
+    if not path:
+        parser.error('No inventory, pass --database or set ' + INVENTORY_ENV)
+    if not os.path.isfile(path):
+        parser.error('No inventory at ' + path)
+    inventory = Inventory(path)
+    try:
+        if args.serial:
+            entries = [inventory.get(serial) for serial in args.serial]
+        else:
+            entries = inventory.list()
+        for entry in entries:
+            if entry is not None:
+                print(json.dumps(entry, sort_keys=True))
+    finally:
+        inventory.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,635 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Simulated YubiKeys, for running the backend without any hardware.
+
+Selected with YKMAN_GUI_BACKEND=simulated, or by passing a
+SimulatedBackend to yubikey.init(). The devices are YubiKey 5 NFCs in
+factory state, their number and the time each command takes are read
+from YKMAN_GUI_SIMULATED_DEVICES and YKMAN_GUI_SIMULATED_LATENCY.
+
+Every command a simulated controller runs goes through the driver's
+send_apdu, so it is delayed and counted like a command to a real key.
+"""
+
+import datetime
+import os
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+from fido2.ctap import CtapError
+from ykman.descriptor import FailedOpeningDeviceException
+from ykman.device import TAG
+from ykman.driver_ccid import APDUError, SW
+from ykman.piv import (
+    ALGO, INS, AuthenticationBlocked, AuthenticationFailed, BadFormat,
+    WrongPin, WrongPuk)
+from ykman.util import APPLICATION, FORM_FACTOR, TRANSPORT, Mode
+
+
+DEVICES_ENV = 'YKMAN_GUI_SIMULATED_DEVICES'
+LATENCY_ENV = 'YKMAN_GUI_SIMULATED_LATENCY'
+
+FIRST_SERIAL = 10000001
+
+DEFAULT_PIN = '123456'
+DEFAULT_PUK = '12345678'
+DEFAULT_MGM_KEY = bytes.fromhex(
+    '010203040506070801020304050607080102030405060708')
+PIN_RETRIES = 3
+FIDO_PIN_RETRIES = 8
+
+# A YubiKey 5 NFC supports all applications over both USB and NFC.
+USB_SUPPORTED = sum(APPLICATION) | TRANSPORT.CCID
+NFC_SUPPORTED = sum(APPLICATION)
+
+
+def from_environment():
+    return SimulatedBackend(
+        devices=int(os.environ.get(DEVICES_ENV) or 1),
+        latency=float(os.environ.get(LATENCY_ENV) or 0))
+
+
+class SimulatedBackend(object):
+
+    name = 'simulated'
+    hotplug = False
+
+    def __init__(self, devices=1, latency=0.0, touch_delay=None):
+        self.latency = latency
+        self.touch_delay = latency if touch_delay is None else touch_delay
+        self.devices = []
+        for _ in range(devices):
+            self.insert()
+
+    def insert(self, device=None):
+        if device is None:
+            serial = max([d.serial for d in self.devices] or
+                         [FIRST_SERIAL - 1]) + 1
+            device = SimulatedDevice(serial, self.latency, self.touch_delay)
+        self.devices.append(device)
+        return device
+
+    def remove(self, serial):
+        for device in list(self.devices):
+            if device.serial == serial:
+                self.devices.remove(device)
+                device.connected = False
+
+    def get_descriptors(self):
+        return [SimulatedDescriptor(device) for device in self.devices]
+
+    def open_device(self, transports, serial):
+        for device in self.devices:
+            if serial is None or device.serial == serial:
+                return device.open(transports)
+        raise FailedOpeningDeviceException()
+
+    def open_devices(self):
+        return [device.open(sum(TRANSPORT)) for device in self.devices]
+
+    def otp_controller(self, driver):
+        return SimulatedOtpController(driver)
+
+    def fido2_controller(self, driver):
+        return SimulatedFido2Controller(driver)
+
+    def piv_controller(self, driver):
+        return SimulatedPivController(driver)
+
+    def piv_slot_occupied(self, driver, slot):
+        driver.send_apdu(0, INS.GET_DATA, 0x3f, 0xff)
+        return slot in driver.device.piv.certs
+
+
+class SimulatedDevice(object):
+
+    def __init__(self, serial, latency=0.0, touch_delay=0.0,
+                 version=(5, 2, 4), form_factor=FORM_FACTOR.USB_A_KEYCHAIN):
+        self.serial = serial
+        self.latency = latency
+        self.touch_delay = touch_delay
+        self.version = version
+        self.form_factor = form_factor
+        self.usb_supported = USB_SUPPORTED
+        self.usb_enabled = USB_SUPPORTED
+        self.nfc_supported = NFC_SUPPORTED
+        self.nfc_enabled = NFC_SUPPORTED
+        self.lock_code = None
+        self.connected = True
+        self.commands = 0
+        self.otp_slots = [False, False]
+        self.fido = FidoState()
+        self.piv = PivState()
+        self.lock = threading.Lock()
+
+    @property
+    def mode(self):
+        transports = 0
+        if self.usb_enabled & APPLICATION.OTP:
+            transports |= TRANSPORT.OTP
+        if self.usb_enabled & (APPLICATION.U2F | APPLICATION.FIDO2):
+            transports |= TRANSPORT.FIDO
+        if self.usb_enabled & APPLICATION.dependent_on_ccid():
+            transports |= TRANSPORT.CCID
+        return Mode(transports or TRANSPORT.CCID)
+
+    def open(self, transports):
+        transports &= self.mode.transports
+        for transport in (TRANSPORT.CCID, TRANSPORT.FIDO, TRANSPORT.OTP):
+            if transports & transport:
+                driver = SimulatedDriver(self, transport)
+                driver.send_apdu(0, 0xa4, 0x04, 0x00)  # Select
+                return SimulatedYubiKey(self, driver)
+        raise FailedOpeningDeviceException()
+
+    def command(self):
+        if not self.connected:
+            raise IOError('Device {} was removed'.format(self.serial))
+        with self.lock:
+            self.commands += 1
+            if self.latency:
+                time.sleep(self.latency)
+
+    def touch(self):
+        if self.touch_delay:
+            time.sleep(self.touch_delay)
+
+
+class PivState(object):
+
+    def __init__(self):
+        self.pin = DEFAULT_PIN
+        self.puk = DEFAULT_PUK
+        self.mgm_key = DEFAULT_MGM_KEY
+        self.pin_tries = PIN_RETRIES
+        self.puk_tries = PIN_RETRIES
+        self.mgm_key_protected = False
+        self.puk_blocked = False
+        self.keys = {}
+        self.certs = {}
+        self.chuid = None
+
+
+class FidoState(object):
+
+    def __init__(self):
+        self.pin = None
+        self.pin_retries = FIDO_PIN_RETRIES
+        self.failures = 0
+
+
+class SimulatedDescriptor(object):
+
+    def __init__(self, device):
+        self._device = device
+
+    @property
+    def fingerprint(self):
+        return ('simulated', self._device.serial)
+
+    @property
+    def version(self):
+        return self._device.version
+
+    @property
+    def mode(self):
+        return self._device.mode
+
+    def open_device(self, transports=sum(TRANSPORT)):
+        return self._device.open(transports)
+
+
+class SimulatedConfig(object):
+
+    def __init__(self, device):
+        self.serial = device.serial
+        self.version = device.version
+        self.form_factor = device.form_factor
+        self.usb_supported = device.usb_supported
+        self.usb_enabled = device.usb_enabled
+        self.nfc_supported = device.nfc_supported
+        self.nfc_enabled = device.nfc_enabled
+        self.configuration_locked = device.lock_code is not None
+
+
+class SimulatedDriver(object):
+
+    def __init__(self, device, transport):
+        self.device = device
+        self.transport = transport
+        self.closed = False
+
+    def send_apdu(self, cl, ins, p1, p2, data=b'', check=SW.OK):
+        if self.closed:
+            raise IOError('Driver is closed')
+        self.device.command()
+        return b'', SW.OK
+
+    def close(self):
+        self.closed = True
+
+
+class SimulatedYubiKey(object):
+
+    def __init__(self, device, driver):
+        self._device = device
+        self._driver = driver
+        self.device_name = 'YubiKey 5 NFC'
+        self.config = SimulatedConfig(device)
+
+    @property
+    def driver(self):
+        return self._driver
+
+    @property
+    def transport(self):
+        return self._driver.transport
+
+    @property
+    def version(self):
+        return self._device.version
+
+    @property
+    def serial(self):
+        return self._device.serial
+
+    @property
+    def can_write_config(self):
+        return self._device.version >= (5, 0, 0)
+
+    @property
+    def mode(self):
+        return self._device.mode
+
+    @mode.setter
+    def mode(self, mode):
+        # Enables the supported applications of the given transports, the
+        # way a YubiKey 5 does it.
+        device = self._device
+        self._driver.send_apdu(0, 0x1c, 0, 0)
+        device.usb_enabled = device.usb_supported & (
+            ((APPLICATION.U2F | APPLICATION.FIDO2) *
+             mode.has_transport(TRANSPORT.FIDO)) |
+            (APPLICATION.dependent_on_ccid() *
+             mode.has_transport(TRANSPORT.CCID)) |
+            (APPLICATION.OTP * mode.has_transport(TRANSPORT.OTP)) |
+            TRANSPORT.CCID)
+        self.close()
+
+    def write_config(self, values, reboot=False, lock_key=None):
+        device = self._device
+        self._driver.send_apdu(0, 0x1c, 0, 0)
+        if device.lock_code is not None:
+            if not lock_key:
+                raise ValueError('Configuration locked!')
+            if lock_key != device.lock_code:
+                raise APDUError(b'', SW.VERIFY_FAIL_NO_RETRY)
+        if TAG.USB_ENABLED in values:
+            device.usb_enabled = int.from_bytes(
+                values[TAG.USB_ENABLED], 'big')
+        if TAG.NFC_ENABLED in values:
+            device.nfc_enabled = int.from_bytes(
+                values[TAG.NFC_ENABLED], 'big')
+        if TAG.CONFIG_LOCK in values:
+            lock_code = values[TAG.CONFIG_LOCK]
+            device.lock_code = None if not any(lock_code) else lock_code
+        if reboot:
+            self.close()
+        else:
+            self.config = SimulatedConfig(device)
+
+    def close(self):
+        self._driver.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class SimulatedOtpController(object):
+
+    def __init__(self, driver):
+        self._driver = driver
+        self._device = driver.device
+
+    @property
+    def slot_status(self):
+        self._driver.send_apdu(0, 0x01, 0x13, 0)
+        return tuple(self._device.otp_slots)
+
+    def _program(self, slot):
+        self._driver.send_apdu(0, 0x01, slot, 0)
+        self._device.otp_slots[slot - 1] = True
+
+    def program_otp(self, slot, key, fixed, uid, config=None):
+        self._program(slot)
+
+    def prepare_upload_key(self, key, public_id, private_id, serial=None,
+                           user_agent='python-yubikey-manager'):
+        # Nothing is uploaded, as if the upload had been done in a browser.
+        return None
+
+    def program_static(self, slot, password, append_cr=True,
+                       keyboard_layout=None, config=None):
+        self._program(slot)
+
+    def program_chalresp(self, slot, key, touch=False, config=None):
+        self._program(slot)
+
+    def program_hotp(self, slot, key, imf=0, hotp8=False, config=None):
+        self._program(slot)
+
+    def zap_slot(self, slot):
+        self._driver.send_apdu(0, 0x01, slot, 0)
+        self._device.otp_slots[slot - 1] = False
+
+    def swap_slots(self):
+        self._driver.send_apdu(0, 0x01, 0x06, 0)
+        self._device.otp_slots.reverse()
+
+
+class SimulatedFido2Controller(object):
+
+    def __init__(self, driver):
+        self._driver = driver
+        self._device = driver.device
+
+    @property
+    def _fido(self):
+        return self._device.fido
+
+    @property
+    def has_pin(self):
+        self._driver.send_apdu(0, 0x10, 0, 0)
+        return self._fido.pin is not None
+
+    def get_pin_retries(self):
+        self._driver.send_apdu(0, 0x10, 0, 0)
+        return self._fido.pin_retries
+
+    def set_pin(self, pin):
+        self._driver.send_apdu(0, 0x10, 0, 0)
+        if self._fido.pin is not None:
+            raise CtapError(CtapError.ERR.NOT_ALLOWED)
+        self._check_policy(pin)
+        self._fido.pin = pin
+
+    def change_pin(self, old_pin, new_pin):
+        self._driver.send_apdu(0, 0x10, 0, 0)
+        fido = self._fido
+        if fido.pin_retries == 0:
+            raise CtapError(CtapError.ERR.PIN_BLOCKED)
+        if fido.failures >= 3:
+            raise CtapError(CtapError.ERR.PIN_AUTH_BLOCKED)
+        if old_pin != fido.pin:
+            fido.pin_retries -= 1
+            fido.failures += 1
+            if fido.pin_retries == 0:
+                raise CtapError(CtapError.ERR.PIN_BLOCKED)
+            if fido.failures >= 3:
+                raise CtapError(CtapError.ERR.PIN_AUTH_BLOCKED)
+            raise CtapError(CtapError.ERR.PIN_INVALID)
+        self._check_policy(new_pin)
+        fido.pin = new_pin
+        fido.pin_retries = FIDO_PIN_RETRIES
+        fido.failures = 0
+
+    def reset(self, touch_callback=None):
+        self._driver.send_apdu(0, 0x10, 0, 0)
+        if touch_callback:
+            touch_callback()
+        self._device.touch()
+        self._device.fido = FidoState()
+
+    def _check_policy(self, pin):
+        if not 4 <= len(pin.encode()) <= 63:
+            raise CtapError(CtapError.ERR.PIN_POLICY_VIOLATION)
+
+
+class SimulatedPivController(object):
+
+    def __init__(self, driver):
+        self._driver = driver
+        self._device = driver.device
+        self._authenticated = False
+        self._verified = False
+
+    @property
+    def _piv(self):
+        return self._device.piv
+
+    def _send(self, ins, p1=0, p2=0):
+        self._driver.send_apdu(0, ins, p1, p2)
+
+    def _wrong_pin(self, tries_left):
+        return WrongPin(0x63c0 | tries_left, self.version)
+
+    def _require_auth(self):
+        if not self._authenticated:
+            raise APDUError(b'', SW.SECURITY_CONDITION_NOT_SATISFIED)
+
+    @property
+    def version(self):
+        return self._device.version
+
+    @property
+    def has_protected_key(self):
+        return self.has_derived_key or self.has_stored_key
+
+    @property
+    def has_derived_key(self):
+        return False
+
+    @property
+    def has_stored_key(self):
+        return self._piv.mgm_key_protected
+
+    @property
+    def puk_blocked(self):
+        return self._piv.puk_blocked
+
+    @property
+    def supported_algorithms(self):
+        return [algorithm for algorithm in ALGO if algorithm != ALGO.TDES]
+
+    def verify(self, pin, touch_callback=None):
+        self._send(INS.VERIFY)
+        piv = self._piv
+        if piv.pin_tries == 0:
+            raise AuthenticationBlocked(
+                'PIN is blocked.', SW.AUTH_METHOD_BLOCKED)
+        if pin != piv.pin:
+            piv.pin_tries -= 1
+            raise self._wrong_pin(piv.pin_tries)
+        piv.pin_tries = PIN_RETRIES
+        self._verified = True
+        if self.has_stored_key:
+            self._authenticated = True
+
+    def change_pin(self, old_pin, new_pin):
+        self._send(INS.CHANGE_REFERENCE)
+        self.verify(old_pin)
+        if not 6 <= len(new_pin) <= 8:
+            raise APDUError(b'', SW.INCORRECT_PARAMETERS)
+        self._piv.pin = new_pin
+
+    def change_puk(self, old_puk, new_puk):
+        self._send(INS.CHANGE_REFERENCE, 0, 0x81)
+        self._verify_puk(old_puk)
+        self._piv.puk = new_puk
+
+    def unblock_pin(self, puk, new_pin):
+        self._send(INS.RESET_RETRY)
+        self._verify_puk(puk)
+        self._piv.pin = new_pin
+        self._piv.pin_tries = PIN_RETRIES
+
+    def _verify_puk(self, puk):
+        piv = self._piv
+        if piv.puk_tries == 0:
+            raise AuthenticationBlocked(
+                'PUK is blocked.', SW.AUTH_METHOD_BLOCKED)
+        if puk != piv.puk:
+            piv.puk_tries -= 1
+            if piv.puk_tries == 0:
+                piv.puk_blocked = True
+            raise WrongPuk(0x63c0 | piv.puk_tries, self.version)
+        piv.puk_tries = PIN_RETRIES
+
+    def authenticate(self, key, touch_callback=None):
+        self._send(INS.AUTHENTICATE)
+        if len(key) != 24:
+            raise BadFormat(
+                'Management key must be exactly 24 bytes long, '
+                'was: {}'.format(len(key)), None)
+        if key != self._piv.mgm_key:
+            raise AuthenticationFailed(
+                'Incorrect management key',
+                SW.SECURITY_CONDITION_NOT_SATISFIED, self.version)
+        self._authenticated = True
+
+    def set_mgm_key(self, new_key, touch=False, store_on_device=False):
+        self._send(INS.SET_MGMKEY, 0xff, 0xfe if touch else 0xff)
+        self._require_auth()
+        if not new_key:
+            if not store_on_device:
+                raise ValueError('new_key was not given and '
+                                 'store_on_device was not True')
+            new_key = os.urandom(24)
+        if len(new_key) != 24:
+            raise BadFormat(
+                'Management key must be exactly 24 bytes long, '
+                'was: {}'.format(len(new_key)), new_key)
+        self._piv.mgm_key = new_key
+        self._piv.mgm_key_protected = store_on_device
+
+    def get_pin_tries(self):
+        self._send(INS.VERIFY)
+        return self._piv.pin_tries
+
+    def reset(self):
+        self._send(INS.RESET)
+        self._device.piv = PivState()
+        self._authenticated = False
+        self._verified = False
+
+    def generate_key(self, slot, algorithm, pin_policy=None,
+                     touch_policy=None):
+        self._send(INS.GENERATE_ASYMMETRIC, 0, slot)
+        self._require_auth()
+        if algorithm in (ALGO.ECCP256, ALGO.ECCP384):
+            curve = ec.SECP256R1 if algorithm == ALGO.ECCP256 \
+                else ec.SECP384R1
+            key = ec.generate_private_key(curve(), default_backend())
+        else:
+            key = rsa.generate_private_key(
+                65537, 1024 if algorithm == ALGO.RSA1024 else 2048,
+                default_backend())
+        self._piv.keys[slot] = key
+        return key.public_key()
+
+    def _sign(self, slot, builder, touch_callback=None):
+        self._send(INS.AUTHENTICATE, 0, slot)
+        if not self._verified:
+            raise APDUError(b'', SW.SECURITY_CONDITION_NOT_SATISFIED)
+        if slot not in self._piv.keys:
+            raise APDUError(b'', SW.INCORRECT_PARAMETERS)
+        return builder.sign(
+            self._piv.keys[slot], hashes.SHA256(), default_backend())
+
+    def generate_self_signed_certificate(
+            self, slot, public_key, common_name, valid_from, valid_to,
+            touch_callback=None):
+        name = x509.Name(
+            [x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+        builder = x509.CertificateBuilder() \
+            .public_key(public_key) \
+            .subject_name(name) \
+            .issuer_name(name) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(valid_from) \
+            .not_valid_after(valid_to)
+        self.import_certificate(
+            slot, self._sign(slot, builder, touch_callback))
+
+    def generate_certificate_signing_request(self, slot, public_key, subject,
+                                             touch_callback=None):
+        builder = x509.CertificateSigningRequestBuilder().subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject)]))
+        return self._sign(slot, builder, touch_callback)
+
+    def import_key(self, slot, key, pin_policy=None, touch_policy=None):
+        self._send(INS.IMPORT_KEY, 0, slot)
+        self._require_auth()
+        self._piv.keys[slot] = key
+
+    def import_certificate(self, slot, certificate, verify=False,
+                           touch_callback=None):
+        self._send(INS.PUT_DATA, 0x3f, 0xff)
+        self._require_auth()
+        self._piv.certs[slot] = certificate
+
+    def read_certificate(self, slot):
+        self._send(INS.GET_DATA, 0x3f, 0xff)
+        if slot not in self._piv.certs:
+            raise APDUError(b'', SW.NOT_FOUND)
+        return self._piv.certs[slot]
+
+    def delete_certificate(self, slot):
+        self._send(INS.PUT_DATA, 0x3f, 0xff)
+        self._require_auth()
+        self._piv.certs.pop(slot, None)
+
+    def list_certificates(self):
+        self._send(INS.GET_DATA, 0x3f, 0xff)
+        return dict(self._piv.certs)
+
+    def update_chuid(self):
+        self._send(INS.PUT_DATA, 0x3f, 0xff)
+        self._require_auth()
+        self._piv.chuid = os.urandom(16)
+
+
+def self_signed_certificate(common_name='Simulated', days=365):
+    # A certificate and key to put in a slot, e.g. to set up a device
+    # that already has certificates.
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.utcnow()
+    cert = x509.CertificateBuilder() \
+        .public_key(key.public_key()) \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=days)) \
+        .sign(key, hashes.SHA256(), default_backend())
+    return cert, key
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Background upload of Yubico OTP credentials to YubiCloud.
+
+An upload is prepared after the slot has been programmed, by posting the
+credential to the upload endpoint, which answers with a URL where the
+upload is finished in a browser. Uploads are retried with exponential
+backoff while the endpoint is unreachable or unavailable, over
+connections that are kept open between uploads.
+
+Every upload is kept in a spool directory, one JSON file per upload, so
+pending uploads survive a restart. The spool holds the secret keys of
+pending uploads and is only readable by the user, the keys are removed
+once an upload has been prepared or has failed. A failed upload keeps
+its keys in memory only, so it can be retried until the process exits.
+The endpoint and the spool
+directory are read from YKMAN_GUI_UPLOAD_URL and YKMAN_GUI_UPLOAD_SPOOL,
+for instance to upload to a local stand-in server.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+
+from binascii import b2a_hex
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+URL_ENV = 'YKMAN_GUI_UPLOAD_URL'
+SPOOL_ENV = 'YKMAN_GUI_UPLOAD_SPOOL'
+
+UPLOAD_URL = 'https://upload.yubico.com/prepare'
+SPOOL_DIR = os.path.join(os.path.expanduser('~'), '.ykman-gui', 'uploads')
+
+# Uploads running at once, and connections kept open to the endpoint.
+UPLOAD_WORKERS = 2
+
+# Seconds to wait for the endpoint to respond.
+UPLOAD_TIMEOUT = 10.0
+
+# Attempts before an upload fails, and the delay in seconds before the
+# second attempt, doubled for every attempt after it up to BACKOFF_MAX.
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 300.0
+
+# Responses worth trying again later. Other errors mean the upload was
+# rejected and would be rejected again.
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def from_environment(on_change=None):
+    return Uploader(
+        os.environ.get(SPOOL_ENV) or SPOOL_DIR,
+        url=os.environ.get(URL_ENV) or UPLOAD_URL,
+        on_change=on_change)
+
+
+def has_pending(spool_dir=None):
+    # Whether the spool holds uploads still to be made, without setting
+    # up an Uploader.
+    spool_dir = spool_dir or os.environ.get(SPOOL_ENV) or SPOOL_DIR
+    try:
+        names = [n for n in os.listdir(spool_dir) if n.endswith('.json')]
+    except OSError:
+        return False
+    for name in names:
+        try:
+            with open(os.path.join(spool_dir, name), 'r') as f:
+                if json.load(f).get('state') == PENDING:
+                    return True
+        except (OSError, ValueError):
+            continue
+    return False
+
+
+class ConnectionPool(object):
+    # Keeps HTTP connections to one endpoint open between requests.
+
+    def __init__(self, url, size=UPLOAD_WORKERS, timeout=UPLOAD_TIMEOUT):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported upload URL: ' + url)
+        self.url = url
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+        self._https = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port
+        self._size = size
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def request(self, method, body, headers):
+        # Returns the status and body of the response. A kept connection
+        # may have been closed by the server, the request is then sent
+        # again on a new one.
+        import http.client
+        conn, reused = self._get()
+        try:
+            conn.request(method, self.path, body=body, headers=headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            conn, _ = self._get(new=True)
+            try:
+                conn.request(method, self.path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except Exception:
+                conn.close()
+                raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put(conn)
+        return resp.status, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _get(self, new=False):
+        import http.client
+        if not new:
+            with self._lock:
+                if self._idle:
+                    return self._idle.pop(), True
+        connection_type = http.client.HTTPSConnection if self._https \
+            else http.client.HTTPConnection
+        return connection_type(
+            self._host, self._port, timeout=self._timeout), False
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+
+class Uploader(object):
+
+    def __init__(self, spool_dir, url=UPLOAD_URL, workers=UPLOAD_WORKERS,
+                 max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_BASE,
+                 max_backoff=BACKOFF_MAX, timeout=UPLOAD_TIMEOUT,
+                 on_change=None):
+        self.spool_dir = spool_dir
+        self.url = url
+        self._pool = ConnectionPool(url, workers, timeout)
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._on_change = on_change
+        self._records = OrderedDict()
+        self._running = set()
+        self._threads = []
+        self._closed = False
+        self._cond = threading.Condition()
+        self._load()
+
+    def start(self):
+        with self._cond:
+            if self._threads or self._closed:
+                return
+            for i in range(self._workers):
+                thread = threading.Thread(
+                    target=self._work, name='Uploader-%d' % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._pool.close()
+
+    def enqueue(self, key, public_id, private_id, serial=None,
+                user_agent='ykman-qt'):
+        # Takes the credential as bytes, like OtpController.program_otp.
+        from ykman.util import modhex_encode
+        now = time.time()
+        record = {
+            'id': uuid.uuid4().hex,
+            'state': PENDING,
+            'public_id': modhex_encode(public_id),
+            'serial': serial,
+            'user_agent': user_agent,
+            'created': now,
+            'attempts': 0,
+            'next_attempt': now,
+            'errors': [],
+            'finish_url': None,
+            'data': {
+                'aes_key': b2a_hex(key).decode('utf-8'),
+                'serial': serial or 0,
+                'public_id': modhex_encode(public_id),
+                'private_id': b2a_hex(private_id).decode('utf-8'),
+            },
+        }
+        with self._cond:
+            self._write(record)
+            self._records[record['id']] = record
+            self._cond.notify()
+        self.start()
+        return record['id']
+
+    def retry(self, upload_id):
+        with self._cond:
+            record = self._records.get(upload_id)
+            if record is None or record['state'] != FAILED or \
+                    record['data'] is None:
+                return False
+            record.update(
+                state=PENDING, attempts=0, next_attempt=time.time(),
+                errors=[])
+            self._write(record)
+            self._cond.notify()
+        self.start()
+        return True
+
+    def get(self, upload_id):
+        with self._cond:
+            record = self._records.get(upload_id)
+            return None if record is None else _public(record)
+
+    def list(self):
+        with self._cond:
+            return [_public(record) for record in self._records.values()]
+
+    def pending(self):
+        with self._cond:
+            return sum(1 for record in self._records.values()
+                       if record['state'] == PENDING)
+
+    def clear(self):
+        # Forgets the uploads that are done or failed.
+        with self._cond:
+            for upload_id, record in list(self._records.items()):
+                if record['state'] != PENDING:
+                    del self._records[upload_id]
+                    self._remove(upload_id)
+
+    def wait(self, upload_ids=None, timeout=None):
+        # Waits for the given uploads, or all of them, to be done or to
+        # fail. Returns False if some are still pending after timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                ids = self._records.keys() if upload_ids is None \
+                    else upload_ids
+                if all(self._records[i]['state'] != PENDING
+                       for i in ids if i in self._records):
+                    return True
+                remaining = None if deadline is None \
+                    else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                record = self._next()
+                if record is None:
+                    return
+                self._running.add(record['id'])
+            try:
+                changes = self._attempt(record)
+            except Exception as e:
+                logger.error('Upload %s failed', record['id'], exc_info=e)
+                changes = self._retry(record, ['CONNECTION_FAILED'])
+            with self._cond:
+                self._running.discard(record['id'])
+                if record['id'] in self._records:
+                    record.update(changes)
+                    if record['state'] == DONE:
+                        # The keys are on YubiCloud now.
+                        record['data'] = None
+                    self._write(record)
+                self._cond.notify_all()
+            if self._on_change is not None and \
+                    record['state'] != PENDING:
+                self._on_change(_public(record))
+
+    def _next(self):
+        # The pending upload whose next attempt is due first, once it is.
+        while not self._closed:
+            waiting = [record for record in self._records.values()
+                       if record['state'] == PENDING and
+                       record['id'] not in self._running]
+            if not waiting:
+                self._cond.wait()
+                continue
+            record = min(waiting, key=lambda r: r['next_attempt'])
+            delay = record['next_attempt'] - time.time()
+            if delay <= 0:
+                return record
+            self._cond.wait(delay)
+        return None
+
+    def _attempt(self, record):
+        import http.client
+        body = json.dumps(
+            record['data'], indent=False, sort_keys=True).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'User-Agent': record['user_agent'],
+        }
+        try:
+            status, resp_body = self._pool.request('POST', body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            logger.debug('Failed to connect to %s', self.url, exc_info=e)
+            return self._retry(record, ['CONNECTION_FAILED'])
+
+        if status == 200:
+            try:
+                finish_url = json.loads(
+                    resp_body.decode('utf-8'))['finish_url']
+            except (ValueError, TypeError, KeyError) as e:
+                logger.debug('Invalid response: %s', resp_body, exc_info=e)
+                return {'state': FAILED, 'errors': ['INVALID_RESPONSE']}
+            return {'state': DONE, 'errors': [], 'finish_url': finish_url}
+        logger.debug('Upload failed with status %d: %s', status, resp_body)
+        if status in RETRY_STATUSES:
+            return self._retry(record, ['SERVICE_UNAVAILABLE'])
+        if status == 404:
+            errors = ['NOT_FOUND']
+        else:
+            try:
+                errors = json.loads(resp_body.decode('utf-8')).get('errors')
+            except Exception:
+                errors = []
+        return {'state': FAILED, 'errors': errors or []}
+
+    def _retry(self, record, errors):
+        attempts = record['attempts'] + 1
+        if attempts >= self._max_attempts:
+            return {'state': FAILED, 'attempts': attempts, 'errors': errors}
+        # Jittered, so uploads that failed together are not retried
+        # together.
+        delay = min(self._max_backoff,
+                    self._backoff * 2 ** (attempts - 1))
+        return {
+            'attempts': attempts,
+            'errors': errors,
+            'next_attempt': time.time() + delay * random.uniform(0.5, 1.0),
+        }
+
+    def _load(self):
+        if not os.path.isdir(self.spool_dir):
+            return
+        records = []
+        for name in os.listdir(self.spool_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.spool_dir, name), 'r') as f:
+                    records.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning('Skipping unreadable upload %s', name,
+                               exc_info=e)
+        for record in sorted(records, key=lambda r: r['created']):
+            record.setdefault('data', None)
+            if record['state'] == PENDING:
+                # Try again right away, we may have been offline for long.
+                record['next_attempt'] = time.time()
+            elif record['data'] is not None:
+                self._write(record)  # Removes keys spooled with it.
+            self._records[record['id']] = record
+
+    def _path(self, upload_id):
+        return os.path.join(self.spool_dir, upload_id + '.json')
+
+    def _write(self, record):
+        # Written to a temporary file first, so a crash does not leave a
+        # truncated record behind.
+        # Only pending uploads need their keys after a restart.
+        if record['state'] != PENDING:
+            record = _public(record)
+        os.makedirs(self.spool_dir, mode=0o700, exist_ok=True)
+        path = self._path(record['id'])
+        tmp_path = path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _remove(self, upload_id):
+        try:
+            os.remove(self._path(upload_id))
+        except FileNotFoundError:
+            pass
+
+
+def _public(record):
+    # A record without the secrets.
+    return {k: v for k, v in record.items() if k != 'data'}
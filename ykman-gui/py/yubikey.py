@@ -2,14 +2,20 @@
 # -*- coding: utf-8 -*-
 
 
+import atexit
 import datetime
+import hashlib
+import itertools
 import json
 import logging
+import logging.handlers
 import os
+import queue
+import re
 import sys
-import pyotherside
-import smartcard
 import struct
+import threading
+import time
 import types
 import getpass
 import urllib.parse
@@ -17,27 +23,96 @@ import ykman.logging_setup
 
 from base64 import b32decode
 from binascii import b2a_hex, a2b_hex
-from fido2.ctap import CtapError
-from cryptography import x509
-from cryptography.hazmat.primitives import serialization
-from ykman.descriptor import FailedOpeningDeviceException, get_descriptors
-from ykman.device import device_config
-from ykman.otp import OtpController, PrepareUploadFailed
-from ykman.fido import Fido2Controller
-from ykman.driver_ccid import APDUError, SW
-from ykman.driver_otp import YkpersError, libversion as ykpers_version
-from ykman.piv import (
-    PivController, ALGO, SLOT, AuthenticationBlocked,
-    AuthenticationFailed, BadFormat, WrongPin, WrongPuk)
-from ykman.scancodes import KEYBOARD_LAYOUT
-from ykman.util import (
-    APPLICATION, TRANSPORT, Mode, modhex_encode, modhex_decode,
-    generate_static_pw, parse_certificates, get_leaf_certificates,
-    parse_private_key)
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+try:
+    import pyotherside
+except ImportError:  # Used without the GUI, e.g. for batch provisioning.
+    pyotherside = None
 
 
 logger = logging.getLogger(__name__)
 
+# PC/SC pseudo-reader that reports readers being added or removed.
+PNP_NOTIFICATION = '\\\\?PnP?\\Notification'
+
+# Seconds a USB enumeration is reused before enumerating again.
+DESCRIPTOR_TTL = 1.0
+
+# Seconds an unused device session is kept open before it is closed.
+SESSION_IDLE_TIMEOUT = 10.0
+
+# Upper bound on threads used to read multiple devices concurrently.
+MAX_REFRESH_WORKERS = 16
+
+# Number of parsed certificate summaries kept in memory.
+CERT_CACHE_SIZE = 256
+
+# Parsed import files kept between piv_can_parse and piv_import_file, and
+# for how many seconds. They may hold private keys, so both are small.
+IMPORT_CACHE_SIZE = 4
+IMPORT_CACHE_TTL = 60.0
+
+# Sizes in bytes of the OTP secret keys refresh_otp suggests, for Yubico OTP
+# and for challenge-response.
+OTP_KEY_SIZES = (16, 20)
+
+# Earlier versions of the device info kept to answer snapshot(since) with
+# only what changed.
+DEV_INFO_HISTORY = 8
+
+# Seconds a PIV transaction may sit idle before it is aborted. Other calls
+# to the device wait while a transaction is open.
+TRANSACTION_TIMEOUT = 30.0
+
+# Operations of piv_transaction_execute and the methods running them.
+PIV_TRANSACTION_STEPS = {
+    'generate': '_piv_step_generate',
+    'self_sign': '_piv_step_self_sign',
+    'csr': '_piv_step_csr',
+    'import': '_piv_step_import',
+    'delete_certificate': '_piv_step_delete_certificate',
+    'set_chuid': '_piv_step_set_chuid',
+}
+
+# Values reported by refresh_piv besides the certificates.
+PIV_FIELDS = (
+    'has_derived_key', 'has_protected_key', 'has_stored_key', 'pin_tries',
+    'puk_blocked', 'supported_algorithms')
+
+# Upper bounds in seconds of the call latency histogram buckets, slower
+# calls are counted in a last, unbounded bucket.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+# Environment variable naming a file that metrics are written to on exit.
+METRICS_FILE_ENV = 'YKMAN_GUI_METRICS_FILE'
+
+# Recent log records kept in memory, returned by get_log.
+LOG_BUFFER_SIZE = 1000
+
+# Environment variable naming a file the recent log records are written to
+# whenever an error is logged.
+LOG_DUMP_ENV = 'YKMAN_GUI_LOG_DUMP'
+
+# Environment variable naming the device inventory database, see
+# inventory.py. Without it nothing is remembered between runs.
+INVENTORY_ENV = 'YKMAN_GUI_INVENTORY'
+
+# Environment variable selecting the device backend, see _load_backend.
+BACKEND_ENV = 'YKMAN_GUI_BACKEND'
+
+# Threads running the requests submitted through the RequestExecutor.
+EXECUTOR_WORKERS = 4
+
+# Requests in a lower lane run first. PIV transaction steps have a lane of
+# their own, requests in other lanes for the device wait for the transaction.
+LANES = {'transaction': 0, 'interactive': 1, 'background': 2}
+
+# How long the hotplug watcher blocks on PC/SC before checking for shutdown.
+HOTPLUG_TIMEOUT_MS = 1000
+
 
 def as_json(f):
     def wrapped(*args, **kwargs):
@@ -50,22 +125,21 @@ def catch_error(f):
         try:
             return f(*args, **kwargs)
 
-        except YkpersError as e:
-            if e.errno == 3:
-                return failure('write error')
-            if e.errno == 4:
-                return failure('timeout')
-
-            logger.error('Uncaught exception', exc_info=e)
-            return unknown_failure(e)
-
-        except FailedOpeningDeviceException:
-            return failure('open_device_failed')
-
-        except smartcard.pcsc.PCSCExceptions.EstablishContextException:
-            return failure('pcsc_establish_context_failed')
-
         except Exception as e:
+            if isinstance(e, _loaded_type('ykman.driver_otp', 'YkpersError')):
+                if e.errno == 3:
+                    return failure('write error')
+                if e.errno == 4:
+                    return failure('timeout')
+                logger.error('Uncaught exception', exc_info=e)
+                return unknown_failure(e)
+            if isinstance(e, _loaded_type(
+                    'ykman.descriptor', 'FailedOpeningDeviceException')):
+                return failure('open_device_failed')
+            if isinstance(e, _loaded_type(
+                    'smartcard.pcsc.PCSCExceptions',
+                    'EstablishContextException')):
+                return failure('pcsc_establish_context_failed')
             if str(e) == 'Incorrect padding':
                 return failure('incorrect_padding')
             logger.error('Uncaught exception', exc_info=e)
@@ -74,12 +148,26 @@ def catch_error(f):
     return wrapped
 
 
-def success(result={}):
+def _random_hex(n):
+    return b2a_hex(os.urandom(n)).decode('ascii')
+
+
+def _loaded_type(module_name, name):
+    # Looks up an exception type without importing its module, nothing can
+    # raise it before the module has been loaded.
+    module = sys.modules.get(module_name)
+    return getattr(module, name, ()) if module else ()
+
+
+def success(result=None):
+    # A new dict every time, calls run on many threads at once.
+    result = dict(result or {})
     result['success'] = True
     return result
 
 
-def failure(err_id, result={}):
+def failure(err_id, result=None):
+    result = dict(result or {})
     result['success'] = False
     result['error_id'] = err_id
     return result
@@ -89,86 +177,831 @@ def unknown_failure(exception):
     return failure(None, {'error_message': str(exception)})
 
 
-class OtpContextManager(object):
-    def __init__(self, dev):
-        self._dev = dev
+class MethodMetrics(object):
 
-    def __enter__(self):
-        return OtpController(self._dev.driver)
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.device_opens = 0
+        self.round_trips = 0
+        self.errors = {}
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'total_time': self.total_time,
+            'max_time': self.max_time,
+            'histogram': {
+                'buckets': list(LATENCY_BUCKETS),
+                'counts': list(self.histogram),
+            },
+            'device_opens': self.device_opens,
+            'round_trips': self.round_trips,
+            'errors': dict(self.errors),
+        }
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        self._dev.close()
+
+class Metrics(object):
+    # Records per Controller method how long calls take, how often they
+    # open a device and talk to it, and which errors they return. Work is
+    # attributed to the call running on the current thread, anything done
+    # outside of a call (e.g. loading certificates in the background) is
+    # recorded under '(background)'.
+
+    def __init__(self):
+        self._methods = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def measure(self, name, f):
+        def wrapped(*args, **kwargs):
+            outer = getattr(self._local, 'method', None)
+            self._local.method = name
+            start = time.monotonic()
+            try:
+                result = f(*args, **kwargs)
+            finally:
+                elapsed = time.monotonic() - start
+                self._local.method = outer
+            self._record_call(name, elapsed, result)
+            return result
+        return wrapped
+
+    def _record_call(self, name, elapsed, result):
+        with self._lock:
+            method = self._method(name)
+            method.calls += 1
+            method.total_time += elapsed
+            method.max_time = max(method.max_time, elapsed)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if elapsed <= bound:
+                    break
+            else:
+                i = len(LATENCY_BUCKETS)
+            method.histogram[i] += 1
+            if isinstance(result, dict) and result.get('success') is False:
+                error_id = str(result.get('error_id'))
+                method.errors[error_id] = method.errors.get(error_id, 0) + 1
+
+    def _method(self, name=None):
+        name = name or getattr(self._local, 'method', None) or '(background)'
+        if name not in self._methods:
+            self._methods[name] = MethodMetrics()
+        return self._methods[name]
+
+    def device_opened(self, dev):
+        # Counts the open and wraps the driver so that every command sent
+        # to the device is counted.
+        with self._lock:
+            self._method().device_opens += 1
+        driver = getattr(dev, 'driver', None)
+        for target, attr in ((driver, 'send_apdu'),
+                             (getattr(driver, '_dev', None), 'call')):
+            func = getattr(target, attr, None)
+            if func is not None and not hasattr(func, 'counted'):
+                setattr(target, attr, self._count_round_trips(func))
+        return dev
+
+    def _count_round_trips(self, func):
+        def wrapped(*args, **kwargs):
+            with self._lock:
+                self._method().round_trips += 1
+            return func(*args, **kwargs)
+        wrapped.counted = True
+        return wrapped
+
+    def snapshot(self):
+        with self._lock:
+            return {name: method.as_dict()
+                    for name, method in self._methods.items()}
+
+    def reset(self):
+        with self._lock:
+            self._methods = {}
+
+    def dump(self, path):
+        try:
+            with open(path, 'w') as f:
+                json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            logger.error('Failed to write metrics to %s', path, exc_info=e)
+
+
+class LogBuffer(logging.Handler):
+    # Keeps the most recent log records. Records at dump_level or above
+    # write them all to dump_path, so the lead-up to a failure is kept.
+
+    def __init__(self, capacity=LOG_BUFFER_SIZE, dump_path=None,
+                 dump_level=logging.ERROR):
+        super(LogBuffer, self).__init__()
+        self.dump_path = dump_path
+        self.dump_level = dump_level
+        self._records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self._records.append(record)
+        if self.dump_path and record.levelno >= self.dump_level:
+            try:
+                self.dump(self.dump_path)
+            except (IOError, OSError):
+                self.handleError(record)
+
+    def lines(self, limit=None):
+        with self.lock:
+            records = list(self._records)
+        if limit is not None:
+            records = records[-limit:] if limit > 0 else []
+        return [self.format(record) for record in records]
+
+    def clear(self):
+        with self.lock:
+            self._records.clear()
+
+    def dump(self, path):
+        # Called from emit with the lock held, which is reentrant.
+        with open(path, 'w') as f:
+            for line in self.lines():
+                f.write(line + '\n')
+
+
+class Session(object):
+
+    def __init__(self, dev, controller, generation):
+        self.dev = dev
+        self.controller = controller
+        self.generation = generation
+        self.last_used = time.monotonic()
+
+
+class SessionPool(object):
+    # Keeps one opened device and application controller per device, so
+    # that repeated calls skip the connect and applet selection. Sessions
+    # are taken out of the pool while in use and closed when idle. Devices
+    # are identified by serial, see Controller._device_key, whether a call
+    # addresses them by serial or through the selected descriptor.
+
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._generation = 0
+        self._reaper = None
+        self._device_locks = {}
+        self._lock = threading.RLock()
+
+    def acquire(self, device, descriptor, transport, controller_type):
+        key = (device, transport)
+        # Only one call at a time talks to a device.
+        device_lock = self._device_lock(device)
+        device_lock.acquire()
+        try:
+            with self._lock:
+                # Only keep one transport open, switching closes the others.
+                for other in list(self._sessions):
+                    if other[0] == device and other != key:
+                        self._close(other)
+                session = self._sessions.pop(key, None)
+                generation = self._generation
+
+            if session is None:
+                session = Session(
+                    metrics.device_opened(
+                        descriptor.open_device(transports=transport)),
+                    None, generation)
+            if session.controller is None:
+                try:
+                    session.controller = controller_type(session.dev.driver)
+                except Exception:
+                    session.dev.close()
+                    raise
+        except Exception:
+            device_lock.release()
+            raise
+        return key, session
+
+    def add(self, device, transport, dev):
+        # Adds an already opened device, its controller is created on use.
+        with self._lock:
+            self._store(
+                (device, transport),
+                Session(dev, None, self._generation))
+
+    def release(self, key, session, discard=False):
+        try:
+            with self._lock:
+                if discard:
+                    session.dev.close()
+                else:
+                    self._store(key, session)
+        finally:
+            self._device_lock(key[0]).release()
+
+    def _store(self, key, session):
+        if session.generation != self._generation \
+                or key in self._sessions or self.idle_timeout <= 0:
+            session.dev.close()
+            return
+        session.last_used = time.monotonic()
+        self._sessions[key] = session
+        if self._reaper is None:
+            self._reaper = threading.Thread(
+                target=self._reap, name='SessionReaper', daemon=True)
+            self._reaper.start()
+
+    def open(self, device, descriptor, transports):
+        # Opens the device outside of the pool, e.g. to reconfigure it. Its
+        # pooled sessions would hold on to the interfaces and are closed,
+        # and its lock is held until the device is closed.
+        device_lock = self._device_lock(device)
+        device_lock.acquire()
+        try:
+            self.invalidate(device)
+            dev = metrics.device_opened(
+                descriptor.open_device(transports=transports))
+        except Exception:
+            device_lock.release()
+            raise
+        return LockedDevice(dev, device_lock)
+
+    def _device_lock(self, device):
+        with self._lock:
+            return self._device_locks.setdefault(device, threading.RLock())
+
+    def invalidate(self, device=None):
+        with self._lock:
+            self._generation += 1
+            for key in list(self._sessions):
+                if device is None or key[0] == device:
+                    self._close(key)
+
+    def _close(self, key):
+        session = self._sessions.pop(key)
+        try:
+            session.dev.close()
+        except Exception as e:
+            logger.debug('Failed to close session', exc_info=e)
+
+    def _reap(self):
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            with self._lock:
+                now = time.monotonic()
+                for key, session in list(self._sessions.items()):
+                    if now - session.last_used >= self.idle_timeout:
+                        self._close(key)
+                if not self._sessions:
+                    self._reaper = None
+                    return
 
 
-class Fido2ContextManager(object):
-    def __init__(self, dev):
-        self._dev = dev
+class LockedDevice(object):
+    # A device opened by SessionPool.open, closing it releases its lock.
+
+    def __init__(self, dev, lock):
+        self.dev = dev
+        self._lock = lock
 
     def __enter__(self):
-        return Fido2Controller(self._dev.driver)
+        return self.dev
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._dev.close()
+        try:
+            if self.dev is not None:
+                self.dev.close()
+        finally:
+            self._lock.release()
+
+
+class PivState(object):
+
+    def __init__(self):
+        self.values = {}
+        self.stale = set(PIV_FIELDS)
+        self.certs = {}
+        self.stale_slots = set()
+        self.certs_read = False
+
+
+class PivStateCache(object):
+    # Remembers what refresh_piv read from each device. Writes mark the
+    # fields and slots they touched as stale, and only those are read
+    # from the device again.
 
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._states.setdefault(key, PivState())
+
+    def invalidate(self, key, fields=(), slots=()):
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                state.stale.update(fields)
+                state.stale_slots.update(slots)
+
+    def forget(self, key=None):
+        with self._lock:
+            if key is None:
+                self._states.clear()
+            else:
+                self._states.pop(key, None)
+
+
+class CertificateSummaryCache(object):
+    # Parsed certificate summaries by digest of the DER encoding, shared
+    # between devices since many carry the same certificates.
+
+    def __init__(self, maxsize=CERT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cert):
+        from cryptography.hazmat.primitives import serialization
+        digest = hashlib.sha256(
+            cert.public_bytes(serialization.Encoding.DER)).digest()
+        with self._lock:
+            summary = self._summaries.get(digest)
+            if summary is not None:
+                self._summaries.move_to_end(digest)
+                self.hits += 1
+                return summary
+            self.misses += 1
+
+        summary = _piv_cert_summary(cert)
+        with self._lock:
+            self._summaries[digest] = summary
+            while len(self._summaries) > max(self.maxsize, 0):
+                self._summaries.popitem(last=False)
+        return summary
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._summaries),
+                'maxsize': self.maxsize,
+            }
+
+
+class ParsedFile(object):
+
+    def __init__(self, kind, certs, private_keys):
+        self.kind = kind
+        self.certs = certs
+        self.private_keys = private_keys
+
+    @property
+    def private_key(self):
+        return self.private_keys[0] if self.private_keys else None
+
+
+class ParsedFileCache(object):
+    # Import files are parsed once, by the container type found in the
+    # data, and the result is reused by the calls that follow for the same
+    # file and password. Entries are keyed by modification time, so a
+    # changed file is parsed again.
+
+    def __init__(self, maxsize=IMPORT_CACHE_SIZE, ttl=IMPORT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, path, password=None):
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size,
+               None if password is None else
+               hashlib.sha256(password).digest())
+        with self._lock:
+            entry = self._files.pop(key, None)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            parsed = entry[1]
+        else:
+            with open(path, 'rb') as f:
+                parsed = _parse_import_file(f.read(), password)
+        with self._lock:
+            self._files[key] = (time.monotonic(), parsed)
+            while len(self._files) > self.maxsize:
+                self._files.popitem(last=False)
+        if isinstance(parsed, Exception):
+            raise parsed
+        return parsed
+
+    def discard(self, path):
+        with self._lock:
+            for key in [k for k in self._files if k[0] == path]:
+                del self._files[key]
+
+
+class HardwareBackend(object):
+    # Talks to the YubiKeys connected to this computer. The simulated
+    # backend in simulated.py provides the same methods.
+
+    name = 'hardware'
+    hotplug = True
+
+    def get_descriptors(self):
+        from ykman.descriptor import get_descriptors
+        return list(get_descriptors())
+
+    def open_device(self, transports, serial):
+        from ykman.descriptor import open_device
+        return open_device(transports, serial=serial)
+
+    def open_devices(self):
+        # Connecting is cheap, reading the device info is not, so that part
+        # is done for all devices at once.
+        drivers = list(_open_drivers())
+        if not drivers:
+            return []
+        workers = min(len(drivers), MAX_REFRESH_WORKERS)
+        with ThreadPoolExecutor(workers) as executor:
+            return [dev for dev in executor.map(_open_yubikey, drivers)
+                    if dev is not None]
+
+    def otp_controller(self, driver):
+        from ykman.driver_otp import libversion as ykpers_version
+        from ykman.otp import OtpController
+        if ykpers_version is None:
+            raise Exception(
+                'Could not find the "ykpers" library. Please ensure that '
+                'YubiKey Manager was installed correctly.')
+        return OtpController(driver)
+
+    def fido2_controller(self, driver):
+        from ykman.fido import Fido2Controller
+        return Fido2Controller(driver)
+
+    def piv_controller(self, driver):
+        from ykman.piv import PivController
+        return PivController(driver)
 
-class PivContextManager(object):
-    def __init__(self, dev):
-        self._dev = dev
+    def piv_slot_occupied(self, driver, slot):
+        return _piv_slot_occupied(driver, slot)
+
+
+class SerialTarget(object):
+    # Used in place of a descriptor when a device is addressed by serial.
+
+    def __init__(self, serial, backend):
+        self.serial = int(serial)
+        self._backend = backend
+
+    def open_device(self, transports=None):
+        return self._backend.open_device(
+            transports or _all_transports(), self.serial)
+
+
+class SessionContextManager(object):
+    def __init__(self, pool, device, descriptor, transport, controller_type,
+                 keep_open=True, on_close=None):
+        self._pool = pool
+        self._device = device
+        self._descriptor = descriptor
+        self._transport = transport
+        self._controller_type = controller_type
+        self._keep_open = keep_open
+        self._on_close = on_close
+
+    @property
+    def driver(self):
+        return self._session.dev.driver
 
     def __enter__(self):
-        return PivController(self._dev.driver)
+        self._key, self._session = self._pool.acquire(
+            self._device, self._descriptor, self._transport,
+            self._controller_type)
+        return self._session.controller
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._dev.close()
+        self.close(discard=exc_type is not None)
+
+    def close(self, discard=False):
+        # on_close runs while the session still holds the device.
+        try:
+            if self._on_close is not None:
+                self._on_close()
+        finally:
+            self._pool.release(
+                self._key, self._session,
+                discard=discard or not self._keep_open)
+
+
+class PivTransaction(object):
+    # Holds one PIV session, and the authentication done on it, across
+    # bridge calls. The session is used from a thread of its own, so the
+    # device lock is taken and released by the same thread whichever
+    # thread the calls come from.
+
+    def __init__(self, transaction_id, session, serial=None,
+                 timeout=TRANSACTION_TIMEOUT, on_closed=None):
+        self.id = transaction_id
+        self.serial = serial
+        self.pin = None
+        self.public_keys = {}
+        self.closed = False
+        self._session = session
+        self._timeout = timeout
+        self._on_closed = on_closed
+        self._requests = queue.Queue()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._error = None
+
+    def start(self):
+        threading.Thread(
+            target=self._run, name='PivTransaction-%d' % self.id,
+            daemon=True).start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+    def call(self, func, *args, **kwargs):
+        # Runs func(controller, *args, **kwargs) in the transaction.
+        reply = queue.Queue(1)
+        with self._lock:
+            if self.closed:
+                raise ValueError('Transaction {} is closed'.format(self.id))
+            self._requests.put((func, args, kwargs, reply))
+        ok, value = reply.get()
+        if not ok:
+            raise value
+        return value
+
+    def close(self, discard=False):
+        with self._lock:
+            if not self.closed:
+                self._requests.put((None, discard, None, None))
+
+    def _run(self):
+        try:
+            controller = self._session.__enter__()
+        except Exception as e:
+            self._error = e
+            self.closed = True
+            self._ready.set()
+            return
+        self._ready.set()
+
+        discard = True
+        try:
+            while True:
+                try:
+                    func, args, kwargs, reply = self._requests.get(
+                        timeout=self._timeout)
+                except queue.Empty:
+                    with self._lock:
+                        if self._requests.empty():
+                            logger.debug('PIV transaction %d timed out',
+                                         self.id)
+                            self.closed = True
+                            break
+                    continue
+                if func is None:
+                    discard = args
+                    break
+                try:
+                    reply.put((True, func(controller, *args, **kwargs)))
+                except Exception as e:
+                    reply.put((False, e))
+        finally:
+            with self._lock:
+                self.closed = True
+            self.pin = None
+            self._session.close(discard)
+            if self._on_closed is not None:
+                self._on_closed(self)
+
+
+class DescriptorCache(object):
+
+    def __init__(self, ttl=DESCRIPTOR_TTL, backend=None):
+        self.ttl = ttl
+        self.enumerations_avoided = 0
+        self._backend = backend or HardwareBackend()
+        self._descriptors = None
+        self._timestamp = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._descriptors is not None and \
+                    time.monotonic() - self._timestamp < self.ttl:
+                self.enumerations_avoided += 1
+            else:
+                self._update()
+            return self._descriptors
+
+    def refresh(self):
+        with self._lock:
+            self._update()
+            return self._descriptors
+
+    def invalidate(self):
+        with self._lock:
+            self._descriptors = None
+
+    def _update(self):
+        self._descriptors = self._backend.get_descriptors()
+        self._timestamp = time.monotonic()
 
 
 class Controller(object):
     _descriptor = None
     _dev_info = None
 
-    def __init__(self):
+    def __init__(self, descriptors=None, sessions=None, backend=None,
+                 uploader=None, inventory=None):
+        self._backend = backend or _load_backend()
+        self._uploader = uploader
+        self._inventory = inventory
+        self._descriptors = descriptors or DescriptorCache(
+            backend=self._backend)
+        self._sessions = sessions or SessionPool()
+        self._devices = {}
+        self._device_fingerprints = None
+        # Serials of the keys selected before, so that a key is locked
+        # under its serial while it is selected again.
+        self._fingerprint_serials = {}
+        self._piv_states = PivStateCache()
+        self._otp_states = {}
+        self._dev_generations = itertools.count(1)
+        self._dev_generation = None
+        self._dev_history = OrderedDict()
+        self._transactions = {}
+        self._transaction_ids = itertools.count(1)
+
         # Wrap all return values as JSON.
         for f in dir(self):
             if not f.startswith('_'):
                 func = getattr(self, f)
                 if isinstance(func, types.MethodType):
-                    setattr(self, f, as_json(catch_error(func)))
+                    setattr(self, f, as_json(
+                        metrics.measure(f, catch_error(func))))
 
     def count_devices(self):
-        return len(list(get_descriptors()))
-
-    def _open_device(self, transports=sum(TRANSPORT)):
-        return self._descriptor.open_device(transports=transports)
-
-    def _open_otp_controller(self):
-        if ykpers_version is None:
-            raise Exception(
-                'Could not find the "ykpers" library. Please ensure that '
-                'YubiKey Manager was installed correctly.')
-        return OtpContextManager(
-            self._descriptor.open_device(transports=TRANSPORT.OTP))
-
-    def _open_fido2_controller(self):
-        return Fido2ContextManager(
-            self._descriptor.open_device(transports=TRANSPORT.FIDO))
+        return len(self._descriptors.get())
+
+    def _target(self, serial=None):
+        if serial is None:
+            return self._descriptor
+        return SerialTarget(serial, self._backend)
+
+    def _open_device(self, transports=None, serial=None):
+        return self._sessions.open(
+            self._device_key(serial), self._target(serial),
+            transports or _all_transports())
+
+    def _open_otp_controller(self, serial=None, keep_open=True):
+        from ykman.util import TRANSPORT
+        return SessionContextManager(
+            self._sessions, self._device_key(serial), self._target(serial),
+            TRANSPORT.OTP, self._backend.otp_controller, keep_open)
+
+    def _open_fido2_controller(self, serial=None):
+        from ykman.util import TRANSPORT
+        return SessionContextManager(
+            self._sessions, self._device_key(serial), self._target(serial),
+            TRANSPORT.FIDO, self._backend.fido2_controller)
+
+    def _open_piv(self, serial=None):
+        from ykman.util import TRANSPORT
+        return SessionContextManager(
+            self._sessions, self._device_key(serial), self._target(serial),
+            TRANSPORT.CCID, self._backend.piv_controller)
+
+    def _open_piv_write(self, serial=None, fields=(), slots=()):
+        # A PIV session for a write. What it changes in the cached state is
+        # marked stale once the write is done, before the device is
+        # released, so a concurrent refresh cannot cache the old values.
+        from ykman.util import TRANSPORT
+        return SessionContextManager(
+            self._sessions, self._device_key(serial), self._target(serial),
+            TRANSPORT.CCID, self._backend.piv_controller,
+            on_close=lambda: self._piv_invalidate(serial, fields, slots))
+
+    def _device_key(self, serial=None):
+        # The serial, or for keys not reporting one, the descriptor.
+        if serial is not None:
+            return int(serial)
+        fingerprint = self._descriptor.fingerprint
+        return (self._dev_info or {}).get('serial') or \
+            self._fingerprint_serials.get(fingerprint) or fingerprint
+
+    @property
+    def selected_serial(self):
+        # The key calls without a serial go to, if it is known: the one
+        # selected by the last snapshot, or the only one refresh_devices
+        # found.
+        if self._dev_info and self._dev_info.get('serial'):
+            return self._dev_info['serial']
+        if len(self._devices) == 1:
+            return next(iter(self._devices))
+        return None
+
+    def _serial(self, serial=None):
+        if serial is None:
+            return self._dev_info['serial']
+        return int(serial)
+
+    def refresh_devices(self):
+        self._refresh_devices()
+        return success({
+            'devices': [self._devices[s] for s in sorted(self._devices)]
+        })
 
-    def _open_piv(self):
-        return PivContextManager(
-                self._descriptor.open_device(transports=TRANSPORT.CCID))
+    def _refresh_devices(self):
+        descriptors = self._descriptors.get()
+        fingerprints = {_fingerprint_id(d.fingerprint) for d in descriptors}
+        if fingerprints != self._device_fingerprints:
+            self._sessions.invalidate()
+            self._devices = self._discover_devices()
+            self._device_fingerprints = fingerprints
+
+    def _discover_devices(self):
+        # The opened devices are kept in the session pool for the calls
+        # that follow.
+        devices = {}
+        for dev in self._backend.open_devices():
+            metrics.device_opened(dev)
+            if not dev.serial or dev.serial in devices:
+                # Another interface of a device we have, or no serial to
+                # address it by.
+                dev.close()
+                continue
+            devices[dev.serial] = _device_info(dev)
+            self._remember(dev.serial, 'dev_info', devices[dev.serial])
+            self._piv_states.forget(dev.serial)
+            self._otp_states.pop(dev.serial, None)
+            self._sessions.add(dev.serial, dev.transport, dev)
+        return devices
+
+    def snapshot(self, since=None):
+        # Given the generation of the device info the caller already has,
+        # only the keys that changed since are returned, in 'changes', or
+        # 'not_modified' if none did.
+        descriptors = self._descriptors.get()
+        if len(descriptors) == 1:
+            result = self._refresh(descriptors[0])
+            if result.get('dev') is not None:
+                result = self._dev_info_delta(result, since)
+        else:
+            self._descriptor = None
+            self._sessions.invalidate()
+            result = success({'dev': None})
+        result.update({
+            'n_devices': len(descriptors),
+            'fingerprints': [
+                _fingerprint_id(d.fingerprint) for d in descriptors],
+            'enumerations_avoided': self._descriptors.enumerations_avoided,
+        })
+        return result
+
+    def _dev_info_delta(self, result, since):
+        dev = result['dev']
+        if self._dev_generation is None or \
+                self._dev_history[self._dev_generation] != dev:
+            self._dev_generation = next(self._dev_generations)
+            self._dev_history[self._dev_generation] = dev
+            while len(self._dev_history) > DEV_INFO_HISTORY:
+                self._dev_history.popitem(last=False)
+        result['generation'] = self._dev_generation
+
+        previous = self._dev_history.get(since)
+        if previous is not None:
+            del result['dev']
+            changes = {key: value for key, value in dev.items()
+                       if previous.get(key) != value}
+            if changes:
+                result['changes'] = changes
+            else:
+                result['not_modified'] = True
+        return result
 
     def refresh(self):
-        descriptors = list(get_descriptors())
+        descriptors = self._descriptors.get()
         if len(descriptors) != 1:
             self._descriptor = None
+            self._sessions.invalidate()
             return failure('multiple_devices')
-        desc = descriptors[0]
+        return self._refresh(descriptors[0])
 
+    def _refresh(self, desc):
         # If we have a cached descriptor
         if self._descriptor:
             # Same device, return
             if desc.fingerprint == self._descriptor.fingerprint:
                 return success({'dev': self._dev_info})
 
+        self._sessions.invalidate()
         self._descriptor = desc
         self._dev_info = None
 
@@ -176,33 +1009,62 @@ class Controller(object):
             if not dev:
                 return failure('no_device')
 
-            self._dev_info = {
-                    'name': dev.device_name,
-                    'version': '.'.join(str(x) for x in dev.version),
-                    'serial': dev.serial or '',
-                    'usb_enabled': [
-                        a.name for a in APPLICATION
-                        if a & dev.config.usb_enabled],
-                    'usb_supported': [
-                        a.name for a in APPLICATION
-                        if a & dev.config.usb_supported],
-                    'usb_interfaces_supported': [
-                        t.name for t in TRANSPORT
-                        if t & dev.config.usb_supported],
-                    'nfc_enabled': [
-                        a.name for a in APPLICATION
-                        if a & dev.config.nfc_enabled],
-                    'nfc_supported': [
-                        a.name for a in APPLICATION
-                        if a & dev.config.nfc_supported],
-                    'usb_interfaces_enabled': str(dev.mode).split('+'),
-                    'can_write_config': dev.can_write_config,
-                    'configuration_locked': dev.config.configuration_locked,
-                    'form_factor': dev.config.form_factor
-                }
+            self._dev_info = _device_info(dev)
+            if self._dev_info['serial']:
+                self._fingerprint_serials[desc.fingerprint] = \
+                    self._dev_info['serial']
+            self._piv_states.forget(self._device_key())
+            self._otp_states.pop(self._device_key(), None)
+            self._remember(None, 'dev_info', self._dev_info,
+                           _inventory_fingerprint(desc.fingerprint))
             return success({'dev': self._dev_info})
 
-    def write_config(self, usb_applications, nfc_applications, lock_code):
+    def cached_snapshot(self):
+        # What the inventory remembers of the attached key, to show while
+        # the first snapshot reads it. Finding the key by its fingerprint
+        # only enumerates devices, none is opened.
+        descriptors = self._descriptors.get()
+        entry = None
+        if self._inventory is not None and len(descriptors) == 1:
+            entry = self._inventory.find(
+                _inventory_fingerprint(descriptors[0].fingerprint))
+        if entry is None or 'dev_info' not in entry:
+            return failure('not_cached')
+        return success({
+            'dev': entry['dev_info'],
+            'updated': entry['dev_info_updated'],
+            'n_devices': len(descriptors),
+        })
+
+    def inventory_devices(self, serial=None):
+        # The remembered state of one key, or of all keys seen.
+        if self._inventory is None:
+            return failure('no_inventory')
+        if serial is not None:
+            entry = self._inventory.get(int(serial))
+            if entry is None:
+                return failure('not_cached')
+            return success({'devices': [entry]})
+        return success({'devices': self._inventory.list()})
+
+    def _remember(self, serial, section, values, fingerprint=None):
+        if self._inventory is None:
+            return
+        key = self._device_key(serial)
+        if not isinstance(key, int):
+            return  # No serial to remember it by.
+        try:
+            if fingerprint is not None:
+                self._inventory.seen(key, fingerprint)
+            self._inventory.update(key, section, values)
+        except Exception as e:
+            logger.warning('Failed to update the inventory', exc_info=e)
+
+    def write_config(self, usb_applications, nfc_applications, lock_code,
+                     serial=None):
+        from ykman.device import device_config
+        from ykman.driver_ccid import APDUError, SW
+        from ykman.util import APPLICATION
         usb_enabled = 0x00
         nfc_enabled = 0x00
         for app in usb_applications:
@@ -210,7 +1072,7 @@ class Controller(object):
         for app in nfc_applications:
             nfc_enabled |= APPLICATION[app]
 
-        with self._open_device() as dev:
+        with self._open_device(serial=serial) as dev:
 
             if lock_code:
                 lock_code = a2b_hex(lock_code)
@@ -233,30 +1095,140 @@ class Controller(object):
                 if str(e) == 'Configuration locked!':
                     return failure('interface_config_locked')
                 raise
+            finally:
+                self._descriptors.invalidate()
+                self._sessions.invalidate()
 
             return success()
 
-    def refresh_piv(self):
-        with self._open_piv() as piv_controller:
-            return success({
-                'piv_data': {
-                    'certs': self._piv_list_certificates(piv_controller),
-                    'has_derived_key': piv_controller.has_derived_key,
-                    'has_protected_key': piv_controller.has_protected_key,
-                    'has_stored_key': piv_controller.has_stored_key,
-                    'pin_tries': piv_controller.get_pin_tries(),
-                    'puk_blocked': piv_controller.puk_blocked,
-                    'supported_algorithms':
-                        [a.name for a in piv_controller.supported_algorithms],
-                },
-            })
-
-    def set_mode(self, interfaces):
-        with self._open_device() as dev:
+    def refresh_piv(self, serial=None, lazy=False):
+        key = self._device_key(serial)
+        state = self._piv_states.get(key)
+        changed = []
+        changed_slots = []
+        pending = []
+
+        session = self._open_piv(serial)
+        with session as piv_controller:
+            readers = {
+                'has_derived_key': lambda: piv_controller.has_derived_key,
+                'has_protected_key': lambda: piv_controller.has_protected_key,
+                'has_stored_key': lambda: piv_controller.has_stored_key,
+                'pin_tries': piv_controller.get_pin_tries,
+                'puk_blocked': lambda: piv_controller.puk_blocked,
+                'supported_algorithms': lambda: [
+                    a.name for a in piv_controller.supported_algorithms],
+            }
+            for field in PIV_FIELDS:
+                if field in state.stale or field not in state.values:
+                    value = readers[field]()
+                    if field not in state.values or \
+                            state.values[field] != value:
+                        changed.append(field)
+                    state.values[field] = value
+                    state.stale.discard(field)
+
+            if state.certs_read:
+                slots = [s for s in _piv_cert_slots()
+                         if s.name in state.stale_slots]
+            else:
+                slots = _piv_cert_slots()
+            certs = dict(state.certs)
+            for slot in slots:
+                if lazy:
+                    # Only find out if the slot is in use, the certificate
+                    # is read later.
+                    if self._backend.piv_slot_occupied(
+                            session.driver, slot):
+                        certs[slot.name] = _piv_pending_cert(slot)
+                        pending.append(slot)
+                    else:
+                        certs.pop(slot.name, None)
+                else:
+                    cert = self._piv_read_certificate(piv_controller, slot)
+                    if cert is None:
+                        certs.pop(slot.name, None)
+                    else:
+                        certs[slot.name] = cert
+
+            for slot_name in set(certs) | set(state.certs):
+                if certs.get(slot_name) != state.certs.get(slot_name):
+                    changed_slots.append(slot_name)
+            if changed_slots or not state.certs_read:
+                changed.append('certs')
+            state.certs = certs
+            state.certs_read = True
+            state.stale_slots = {slot.name for slot in pending}
+
+        if pending:
+            threading.Thread(
+                target=self._piv_load_certificates,
+                args=(serial, key, pending), daemon=True).start()
+
+        piv_data = dict(state.values)
+        piv_data['certs'] = dict(state.certs)
+        if not pending:
+            self._remember(serial, 'piv', piv_data)
+        return success({
+            'piv_data': piv_data,
+            'changed': changed,
+            'changed_slots': sorted(changed_slots),
+            'pending_slots': [slot.name for slot in pending],
+        })
+
+    def piv_read_certificate(self, slot_name, serial=None):
+        from ykman.piv import SLOT
+        state = self._piv_states.get(self._device_key(serial))
+        with self._open_piv(serial) as piv_controller:
+            cert = self._piv_read_certificate(piv_controller, SLOT[slot_name])
+            self._piv_store_certificate(state, slot_name, cert)
+        return success({'cert': cert})
+
+    def _piv_load_certificates(self, serial, key, slots):
+        # Streams the certificates of slots that a lazy refresh_piv found
+        # to be in use. Every slot uses its own session so that calls from
+        # the UI can get in between.
+        state = self._piv_states.get(key)
+        try:
+            for slot in slots:
+                if self._device_key(serial) != key:
+                    return
+                with self._open_piv(serial) as piv_controller:
+                    if slot.name not in state.stale_slots:
+                        continue
+                    cert = self._piv_read_certificate(piv_controller, slot)
+                    self._piv_store_certificate(state, slot.name, cert)
+                _send('pivCertificate', slot.name, cert)
+            piv_data = dict(state.values)
+            piv_data['certs'] = dict(state.certs)
+            self._remember(serial, 'piv', piv_data)
+        except Exception as e:
+            logger.debug('Failed to load PIV certificates', exc_info=e)
+        finally:
+            _send('pivCertificatesLoaded')
+
+    def set_mode(self, interfaces, serial=None):
+        from ykman.util import TRANSPORT, Mode
+        with self._open_device(serial=serial) as dev:
             transports = sum([TRANSPORT[i] for i in interfaces])
             dev.mode = Mode(transports & TRANSPORT.usb_transports())
+        self._descriptors.invalidate()
+        self._sessions.invalidate()
+        return success()
+
+    def get_metrics(self):
+        return success({'metrics': metrics.snapshot()})
+
+    def get_log(self, limit=None):
+        return success({'log': log_buffer.lines(limit)})
+
+    def export_log(self, file_url):
+        log_buffer.dump(self._get_file_path(file_url))
         return success()
 
+    def get_cert_cache_stats(self):
+        return success({'cert_cache': cert_summaries.stats()})
+
     def get_username(self):
         username = getpass.getuser()
         return success({'username': username})
@@ -264,50 +1236,104 @@ class Controller(object):
     def is_macos(self):
         return success({'is_macos': sys.platform == 'darwin'})
 
-    def slots_status(self):
-        with self._open_otp_controller() as controller:
-            return success({'status': controller.slot_status})
+    def refresh_otp(self, serial=None):
+        # Slot status and the public ID derived from the serial, read once
+        # per device until a slot is written, and new random candidates for
+        # the private ID and the secret keys.
+        return success({
+            'status': self._otp_slot_status(serial),
+            'serial_modhex': self._otp_serial_modhex(serial),
+            'candidates': {
+                'uid': _random_hex(6),
+                'keys': {str(n): _random_hex(n) for n in OTP_KEY_SIZES},
+            },
+        })
 
-    def erase_slot(self, slot):
-        with self._open_otp_controller() as controller:
+    def _otp_cached(self, serial, name, read):
+        state = self._otp_states.setdefault(self._device_key(serial), {})
+        if name not in state:
+            state[name] = read(serial)
+        return state[name]
+
+    def _otp_slot_status(self, serial=None):
+        def read(serial):
+            with self._open_otp_controller(serial) as controller:
+                status = controller.slot_status
+            self._remember(serial, 'otp', {'status': status})
+            return status
+        return self._otp_cached(serial, 'status', read)
+
+    def _otp_serial_modhex(self, serial=None):
+        return self._otp_cached(serial, 'serial_modhex', self._serial_modhex)
+
+    def _serial_modhex(self, serial=None):
+        # None for keys that do not expose their serial, reported as ''.
+        from ykman.util import TRANSPORT, modhex_encode
+        if serial is None and self._dev_info:
+            serial = self._dev_info['serial']
+        if serial is None:
+            with self._open_device(TRANSPORT.OTP) as dev:
+                serial = dev.serial
+        if serial in (None, ''):
+            return None
+        return modhex_encode(b'\xff\x00' + struct.pack(b'>I', int(serial)))
+
+    def _otp_invalidate(self, serial=None):
+        self._otp_states.pop(self._device_key(serial), None)
+
+    def slots_status(self, serial=None):
+        return success({'status': self._otp_slot_status(serial)})
+
+    def erase_slot(self, slot, serial=None):
+        self._otp_invalidate(serial)
+        with self._open_otp_controller(serial, keep_open=False) as controller:
             controller.zap_slot(slot)
         return success()
 
-    def swap_slots(self):
-        with self._open_otp_controller() as controller:
+    def swap_slots(self, serial=None):
+        self._otp_invalidate(serial)
+        with self._open_otp_controller(serial, keep_open=False) as controller:
             controller.swap_slots()
         return success()
 
-    def serial_modhex(self):
-        with self._open_device(TRANSPORT.OTP) as dev:
-            return modhex_encode(b'\xff\x00' + struct.pack(b'>I', dev.serial))
+    def serial_modhex(self, serial=None):
+        return self._otp_serial_modhex(serial)
 
     def generate_static_pw(self, keyboard_layout):
+        from ykman.scancodes import KEYBOARD_LAYOUT
+        from ykman.util import generate_static_pw
         return success({
             'password': generate_static_pw(
                 38, KEYBOARD_LAYOUT[keyboard_layout])
         })
 
     def random_uid(self):
-        return b2a_hex(os.urandom(6)).decode('ascii')
+        return _random_hex(6)
 
     def random_key(self, bytes):
-        return b2a_hex(os.urandom(int(bytes))).decode('ascii')
+        return _random_hex(int(bytes))
 
     def program_otp(self, slot, public_id, private_id, key, upload=False,
-                    app_version='unknown'):
+                    app_version='unknown', serial=None,
+                    background_upload=False):
+        # With background_upload the slot is programmed first and the
+        # upload is queued, the finish URL is reported by yubicloud_uploads
+        # and an uploadChanged event once it has been prepared.
+        from ykman.util import modhex_decode
+        from ykman.otp import PrepareUploadFailed
         key = a2b_hex(key)
         public_id = modhex_decode(public_id)
         private_id = a2b_hex(private_id)
 
         upload_url = None
 
-        with self._open_otp_controller() as controller:
-            if upload:
+        self._otp_invalidate(serial)
+        with self._open_otp_controller(serial, keep_open=False) as controller:
+            if upload and not background_upload:
                 try:
                     upload_url = controller.prepare_upload_key(
                         key, public_id, private_id,
-                        serial=self._dev_info['serial'],
+                        serial=self._serial(serial),
                         user_agent='ykman-qt/' + app_version)
                 except PrepareUploadFailed as e:
                     logger.debug('YubiCloud upload failed', exc_info=e)
@@ -318,50 +1344,82 @@ class Controller(object):
             controller.program_otp(slot, key, public_id, private_id)
 
         logger.debug('YubiOTP successfully programmed.')
+        if upload and background_upload:
+            upload_id = self._get_uploader().enqueue(
+                key, public_id, private_id, serial=self._serial(serial),
+                user_agent='ykman-qt/' + app_version)
+            return success({'upload_url': None, 'upload_id': upload_id})
         if upload_url:
             logger.debug('Upload url: %s', upload_url)
 
         return success({'upload_url': upload_url})
 
-    def program_challenge_response(self, slot, key, touch):
+    def yubicloud_uploads(self):
+        return success({'uploads': self._get_uploader().list()})
+
+    def yubicloud_retry_upload(self, upload_id):
+        if not self._get_uploader().retry(upload_id):
+            return failure('no_failed_upload')
+        return success()
+
+    def yubicloud_clear_uploads(self):
+        self._get_uploader().clear()
+        return success()
+
+    def _get_uploader(self):
+        return self._uploader or _load_uploader()
+
+    def program_challenge_response(self, slot, key, touch, serial=None):
         key = a2b_hex(key)
-        with self._open_otp_controller() as controller:
+        self._otp_invalidate(serial)
+        with self._open_otp_controller(serial, keep_open=False) as controller:
             controller.program_chalresp(slot, key, touch)
         return success()
 
-    def program_static_password(self, slot, key, keyboard_layout):
-        with self._open_otp_controller() as controller:
+    def program_static_password(self, slot, key, keyboard_layout,
+                                serial=None):
+        from ykman.scancodes import KEYBOARD_LAYOUT
+        self._otp_invalidate(serial)
+        with self._open_otp_controller(serial, keep_open=False) as controller:
             controller.program_static(
                 slot, key,
                 keyboard_layout=KEYBOARD_LAYOUT[keyboard_layout])
         return success()
 
-    def program_oath_hotp(self, slot, key, digits):
+    def program_oath_hotp(self, slot, key, digits, serial=None):
         unpadded = key.upper().rstrip('=').replace(' ', '')
         key = b32decode(unpadded + '=' * (-len(unpadded) % 8))
-        with self._open_otp_controller() as controller:
+        self._otp_invalidate(serial)
+        with self._open_otp_controller(serial, keep_open=False) as controller:
             controller.program_hotp(slot, key, hotp8=(int(digits) == 8))
         return success()
 
-    def fido_has_pin(self):
-        with self._open_fido2_controller() as controller:
-            return success({'hasPin': controller.has_pin})
+    def fido_has_pin(self, serial=None):
+        with self._open_fido2_controller(serial) as controller:
+            has_pin = controller.has_pin
+        self._remember(serial, 'fido', {'has_pin': has_pin})
+        return success({'hasPin': has_pin})
 
-    def fido_pin_retries(self):
+    def fido_pin_retries(self, serial=None):
+        from fido2.ctap import CtapError
         try:
-            with self._open_fido2_controller() as controller:
-                return success({'retries': controller.get_pin_retries()})
+            with self._open_fido2_controller(serial) as controller:
+                retries = controller.get_pin_retries()
         except CtapError as e:
             if e.code == CtapError.ERR.PIN_AUTH_BLOCKED:
                 return failure('PIN authentication is currently blocked. '
                                'Remove and re-insert the YubiKey.')
             if e.code == CtapError.ERR.PIN_BLOCKED:
+                self._remember(serial, 'fido', {'pin_retries': 0})
                 return failure('PIN is blocked.')
             raise
+        self._remember(serial, 'fido', {'pin_retries': retries})
+        return success({'retries': retries})
 
-    def fido_set_pin(self, new_pin):
+    def fido_set_pin(self, new_pin, serial=None):
+        from fido2.ctap import CtapError
         try:
-            with self._open_fido2_controller() as controller:
+            with self._open_fido2_controller(serial) as controller:
                 controller.set_pin(new_pin)
                 return success()
         except CtapError as e:
@@ -370,9 +1428,10 @@ class Controller(object):
                 return failure('too long')
             raise
 
-    def fido_change_pin(self, current_pin, new_pin):
+    def fido_change_pin(self, current_pin, new_pin, serial=None):
+        from fido2.ctap import CtapError
         try:
-            with self._open_fido2_controller() as controller:
+            with self._open_fido2_controller(serial) as controller:
                 controller.change_pin(old_pin=current_pin, new_pin=new_pin)
                 return success()
         except CtapError as e:
@@ -387,9 +1446,10 @@ class Controller(object):
                 return failure('blocked')
             raise
 
-    def fido_reset(self):
+    def fido_reset(self, serial=None):
+        from fido2.ctap import CtapError
         try:
-            with self._open_fido2_controller() as controller:
+            with self._open_fido2_controller(serial) as controller:
                 controller.reset()
                 return success()
         except CtapError as e:
@@ -399,20 +1459,42 @@ class Controller(object):
                 return failure('touch timeout')
             raise
 
-    def piv_reset(self):
-        with self._open_piv() as controller:
-            controller.reset()
+    def piv_reset(self, serial=None):
+        with self._open_piv(serial) as controller:
+            try:
+                controller.reset()
+            finally:
+                self._piv_states.forget(self._device_key(serial))
             return success()
 
-    def _piv_list_certificates(self, controller):
-        return {
-            SLOT(slot).name: _piv_serialise_cert(slot, cert) for slot, cert in controller.list_certificates().items()  # noqa: E501
-        }
+    def _piv_read_certificate(self, controller, slot):
+        from ykman.driver_ccid import APDUError
+        from ykman.piv import InvalidCertificate
+        try:
+            cert = controller.read_certificate(slot)
+        except APDUError:
+            return None
+        except InvalidCertificate:
+            cert = None
+        return _piv_serialise_cert(slot, cert)
+
+    def _piv_store_certificate(self, state, slot_name, cert):
+        if cert is None:
+            state.certs.pop(slot_name, None)
+        else:
+            state.certs[slot_name] = cert
+        state.stale_slots.discard(slot_name)
+
+    def _piv_invalidate(self, serial, fields=(), slots=()):
+        self._piv_states.invalidate(self._device_key(serial), fields, slots)
 
-    def piv_delete_certificate(self, slot_name, pin=None, mgm_key_hex=None):
+    def piv_delete_certificate(self, slot_name, pin=None, mgm_key_hex=None,
+                               serial=None):
+        from ykman.piv import SLOT
         logger.debug('piv_delete_certificate %s', slot_name)
 
-        with self._open_piv() as piv_controller:
+        with self._open_piv_write(
+                serial, ('pin_tries',), (slot_name,)) as piv_controller:
             auth_failed = self._piv_ensure_authenticated(
                 piv_controller, pin=pin, mgm_key_hex=mgm_key_hex)
             if auth_failed:
@@ -423,7 +1505,11 @@ class Controller(object):
 
     def piv_generate_certificate(
             self, slot_name, algorithm, common_name, expiration_date,
-            self_sign=True, csr_file_url=None, pin=None, mgm_key_hex=None):
+            self_sign=True, csr_file_url=None, pin=None, mgm_key_hex=None,
+            serial=None):
+        from cryptography.hazmat.primitives import serialization
+        from ykman.driver_ccid import APDUError, SW
+        from ykman.piv import ALGO, SLOT
         logger.debug('slot_name=%s algorithm=%s common_name=%s '
                      'expiration_date=%s self_sign=%s csr_file_url=%s',
                      slot_name, algorithm, common_name, expiration_date,
@@ -432,7 +1518,8 @@ class Controller(object):
         if csr_file_url:
             file_path = self._get_file_path(csr_file_url)
 
-        with self._open_piv() as piv_controller:
+        with self._open_piv_write(
+                serial, ('pin_tries',), (slot_name,)) as piv_controller:
             auth_failed = self._piv_ensure_authenticated(
                 piv_controller, pin=pin, mgm_key_hex=mgm_key_hex)
             if auth_failed:
@@ -444,15 +1531,8 @@ class Controller(object):
 
             if self_sign:
                 now = datetime.datetime.utcnow()
-                try:
-                    year = int(expiration_date[0:4])
-                    month = int(expiration_date[(4+1):(4+1+2)])
-                    day = int(expiration_date[(4+1+2+1):(4+1+2+1+2)])
-                    valid_to = datetime.datetime(year, month, day)
-                except ValueError as e:
-                    logger.debug(
-                        'Failed to parse date: ' + expiration_date,
-                        exc_info=e)
+                valid_to = _parse_iso8601_date(expiration_date)
+                if valid_to is None:
                     return failure(
                         'invalid_iso8601_date',
                         {'date': expiration_date})
@@ -485,8 +1565,12 @@ class Controller(object):
 
             return success()
 
-    def piv_change_pin(self, old_pin, new_pin):
-        with self._open_piv() as piv_controller:
+    def piv_change_pin(self, old_pin, new_pin, serial=None):
+        from ykman.driver_ccid import APDUError, SW
+        from ykman.piv import AuthenticationBlocked, WrongPin
+        with self._open_piv_write(serial, (
+                'pin_tries', 'puk_blocked', 'has_derived_key',
+                'has_protected_key')) as piv_controller:
             try:
                 piv_controller.change_pin(old_pin, new_pin)
                 logger.debug('PIN change successful!')
@@ -510,8 +1594,10 @@ class Controller(object):
                     'tries_left': tries_left,
                 }
 
-    def piv_change_puk(self, old_puk, new_puk):
-        with self._open_piv() as piv_controller:
+    def piv_change_puk(self, old_puk, new_puk, serial=None):
+        from ykman.piv import AuthenticationBlocked, WrongPuk
+        with self._open_piv_write(
+                serial, ('puk_blocked',)) as piv_controller:
             try:
                 piv_controller.change_puk(old_puk, new_puk)
                 return success()
@@ -523,12 +1609,14 @@ class Controller(object):
                 return failure('wrong_puk', {'tries_left': e.tries_left})
 
     def piv_generate_random_mgm_key(self):
-        return b2a_hex(ykman.piv.generate_random_management_key()).decode(
-            'utf-8')
+        from ykman.piv import generate_random_management_key
+        return b2a_hex(generate_random_management_key()).decode('utf-8')
 
     def piv_change_mgm_key(self, pin, current_key_hex, new_key_hex,
-                           store_on_device=False):
-        with self._open_piv() as piv_controller:
+                           store_on_device=False, serial=None):
+        with self._open_piv_write(serial, (
+                'pin_tries', 'puk_blocked', 'has_derived_key',
+                'has_stored_key', 'has_protected_key')) as piv_controller:
 
             if piv_controller.has_protected_key or store_on_device:
                 pin_failed = self._piv_verify_pin(
@@ -556,8 +1644,10 @@ class Controller(object):
                 new_key, touch=False, store_on_device=store_on_device)
             return success()
 
-    def piv_unblock_pin(self, puk, new_pin):
-        with self._open_piv() as piv_controller:
+    def piv_unblock_pin(self, puk, new_pin, serial=None):
+        from ykman.piv import AuthenticationBlocked, WrongPuk
+        with self._open_piv_write(
+                serial, ('pin_tries', 'puk_blocked')) as piv_controller:
             try:
                 piv_controller.unblock_pin(puk, new_pin)
                 return success()
@@ -569,68 +1659,155 @@ class Controller(object):
                 return failure('wrong_puk', {'tries_left': e.tries_left})
 
     def piv_can_parse(self, file_url):
-        file_path = self._get_file_path(file_url)
-        with open(file_path, 'r+b') as file:
-            data = file.read()
-            try:
-                parse_certificates(data, password=None)
-                return success()
-            except (ValueError, TypeError):
-                pass
-            try:
-                parse_private_key(data, password=None)
-                return success()
-            except (ValueError, TypeError):
-                pass
-        raise ValueError('Failed to parse certificate or key')
+        import_files.parse(self._get_file_path(file_url))
+        return success()
 
     def piv_import_file(self, slot, file_url, password=None,
-                        pin=None, mgm_key=None):
-        is_cert = False
-        is_private_key = False
+                        pin=None, mgm_key=None, serial=None):
+        from ykman.piv import SLOT
         file_path = self._get_file_path(file_url)
         if password:
             password = password.encode()
-        with open(file_path, 'r+b') as file:
-            data = file.read()
-            try:
-                certs = parse_certificates(data, password)
-                is_cert = True
-            except (ValueError, TypeError):
-                pass
-            try:
-                private_key = parse_private_key(data, password)
-                is_private_key = True
-            except (ValueError, TypeError):
-                pass
-
-            if not (is_cert or is_private_key):
-                return failure('failed_parsing')
+        try:
+            parsed = import_files.parse(file_path, password or None)
+        except ValueError:
+            return failure('failed_parsing')
+        is_cert = bool(parsed.certs)
+        is_private_key = parsed.private_key is not None
 
-            with self._open_piv() as controller:
+        # Do not keep the private key around once the import is over,
+        # whether it is on the device or not.
+        try:
+            with self._open_piv_write(
+                    serial, ('pin_tries',), (slot,)) as controller:
                 auth_failed = self._piv_ensure_authenticated(
                     controller, pin, mgm_key)
                 if auth_failed:
                     return auth_failed
                 if is_private_key:
-                    controller.import_key(SLOT[slot], private_key)
+                    controller.import_key(SLOT[slot], parsed.private_key)
                 if is_cert:
-                    if len(certs) > 1:
-                        leafs = get_leaf_certificates(certs)
-                        cert_to_import = leafs[0]
-                    else:
-                        cert_to_import = certs[0]
-
                     controller.import_certificate(
-                            SLOT[slot], cert_to_import)
+                        SLOT[slot], _piv_leaf_certificate(parsed.certs))
+        finally:
+            import_files.discard(file_path)
         return success({
             'imported_cert': is_cert,
             'imported_key': is_private_key
         })
 
-    def piv_export_certificate(self, slot, file_url):
+    def piv_import_files(self, files, password=None, pin=None, mgm_key=None,
+                         serial=None):
+        # Imports a file per slot, given as {slot_name: file_url}.
+        if password:
+            password = password.encode()
+        plan = []
+        paths = []
+        for slot, file_url in sorted(files.items()):
+            path = self._get_file_path(file_url)
+            paths.append(path)
+            try:
+                parsed = import_files.parse(path, password or None)
+            except ValueError:
+                plan.append((slot, None, None, 'failed_parsing'))
+                continue
+            plan.append((slot, _piv_leaf_certificate(parsed.certs),
+                         parsed.private_key, None))
+        try:
+            return self._piv_import_identities(plan, pin, mgm_key, serial)
+        finally:
+            for path in paths:
+                import_files.discard(path)
+
+    def piv_import_bundle(self, file_url, slots=None, password=None,
+                          pin=None, mgm_key=None, serial=None):
+        # Imports every identity in a PEM or PKCS#12 bundle, in order, to
+        # the given slots, or to the slots without a certificate, retired
+        # slots first. Without slots nothing is overwritten, the import is
+        # refused if there are not enough empty slots. Certificates in the
+        # bundle whose key is not in it are listed in 'skipped'.
+        file_path = self._get_file_path(file_url)
+        if password:
+            password = password.encode()
+        try:
+            parsed = import_files.parse(file_path, password or None)
+        except ValueError:
+            return failure('failed_parsing')
+        try:
+            identities, skipped = _piv_bundle_identities(parsed)
+            slots = slots or self._piv_empty_slots(serial)
+            if len(identities) > len(slots):
+                return failure('too_many_identities', {
+                    'identities': len(identities),
+                    'slots': len(slots),
+                })
+            plan = [(slot, cert, key, None)
+                    for slot, (cert, key) in zip(slots, identities)]
+            result = self._piv_import_identities(plan, pin, mgm_key, serial)
+            if 'results' in result:
+                result['skipped'] = [
+                    cert_summaries.get(cert) for cert in skipped]
+            return result
+        finally:
+            import_files.discard(file_path)
+
+    def _piv_empty_slots(self, serial=None):
+        from ykman.piv import SLOT
+        slots = sorted(_piv_cert_slots(),
+                       key=lambda slot: slot >= SLOT.AUTHENTICATION)
+        session = self._open_piv(serial)
+        with session:
+            return [slot.name for slot in slots
+                    if not self._backend.piv_slot_occupied(
+                        session.driver, slot)]
+
+    def _piv_import_identities(self, plan, pin, mgm_key, serial):
+        # Authenticates once and imports every (slot, cert, key) in one
+        # session. A slot that fails does not stop the others.
+        from ykman.piv import SLOT
+        slots = [slot for slot, _, _, _ in plan]
+
+        results = []
+        with self._open_piv_write(
+                serial, ('pin_tries',), slots) as controller:
+            auth_failed = self._piv_ensure_authenticated(
+                controller, pin, mgm_key)
+            if auth_failed:
+                return auth_failed
+
+            for slot, cert, key, error_id in plan:
+                result = {
+                    'slot': slot,
+                    'imported_cert': False,
+                    'imported_key': False,
+                }
+                results.append(result)
+                if error_id:
+                    result.update(success=False, error_id=error_id)
+                    continue
+                try:
+                    if key is not None:
+                        controller.import_key(SLOT[slot], key)
+                        result['imported_key'] = True
+                    if cert is not None:
+                        controller.import_certificate(SLOT[slot], cert)
+                        result['imported_cert'] = True
+                    result['success'] = True
+                except Exception as e:
+                    logger.debug('Failed to import to slot %s', slot,
+                                 exc_info=e)
+                    result.update(success=False, error_id=None,
+                                  error_message=str(e))
+
+        if all(result['success'] for result in results):
+            return success({'results': results})
+        return failure('import_failed', {'results': results})
+
+    def piv_export_certificate(self, slot, file_url, serial=None):
+        from cryptography.hazmat.primitives import serialization
+        from ykman.piv import SLOT
         file_path = self._get_file_path(file_url)
-        with self._open_piv() as controller:
+        with self._open_piv(serial) as controller:
             cert = controller.read_certificate(SLOT[slot])
             with open(file_path, 'wb') as file:
                 file.write(
@@ -638,11 +1815,232 @@ class Controller(object):
                         encoding=serialization.Encoding.PEM))
         return success()
 
+    def piv_export_certificates(self, file_url, per_slot=False,
+                                all_devices=False, serial=None):
+        # Exports the certificate of every slot in use, reading each device
+        # in one session. The certificates go to one PEM bundle, or with
+        # per_slot to <serial>_<slot>.pem files in the directory file_url
+        # points to. With all_devices every attached key is exported.
+        from cryptography.hazmat.primitives import serialization
+        path = self._get_file_path(file_url)
+        if all_devices:
+            self._refresh_devices()
+            serials = sorted(self._devices)
+        else:
+            serials = [serial]
+
+        exported = []
+        unreadable = []
+        # The bundle is written next to its destination and only replaces
+        # it once complete, a failed export leaves no partial file behind.
+        tmp_path = path + '.tmp'
+        bundle = None if per_slot else open(tmp_path, 'wb')
+        try:
+            for device in serials:
+                with self._open_piv(device) as controller:
+                    certs = controller.list_certificates()
+                device_serial = self._serial(device) or 'unknown'
+                for slot in sorted(certs):
+                    entry = {'serial': device_serial, 'slot': slot.name}
+                    if certs[slot] is None:
+                        unreadable.append(entry)
+                        continue
+                    pem = certs[slot].public_bytes(serialization.Encoding.PEM)
+                    if per_slot:
+                        name = '{}_{}.pem'.format(device_serial, slot.name)
+                        with open(os.path.join(path, name), 'wb') as f:
+                            f.write(pem)
+                    else:
+                        bundle.write(pem)
+                    exported.append(entry)
+            if bundle is not None:
+                bundle.close()
+                os.replace(tmp_path, path)
+        except Exception:
+            if bundle is not None:
+                bundle.close()
+                os.remove(tmp_path)
+            raise
+        return success({'exported': exported, 'unreadable': unreadable})
+
+    def piv_transaction_begin(self, pin=None, mgm_key_hex=None, serial=None):
+        # Opens a PIV session that stays open, and authenticated, until the
+        # transaction is committed or aborted, so a sequence of operations
+        # needs one authentication and at most one touch. Steps are run with
+        # piv_transaction_execute. Other calls to the device wait while the
+        # transaction is open.
+        transaction = PivTransaction(
+            next(self._transaction_ids), self._open_piv(serial), serial,
+            on_closed=self._piv_transaction_closed)
+        transaction.start()
+        try:
+            auth_failed = transaction.call(
+                self._piv_transaction_authenticate, pin, mgm_key_hex)
+        finally:
+            self._piv_invalidate(serial, ('pin_tries',))
+        if auth_failed:
+            transaction.close(discard=True)
+            return auth_failed
+        transaction.pin = pin
+        self._transactions[transaction.id] = transaction
+        return success({'transaction': transaction.id})
+
+    def piv_transaction_execute(self, transaction_id, steps):
+        # Runs steps, given as {'op': ..., **args}, in order and stops at the
+        # first one that fails. Operations are generate, self_sign, csr,
+        # import, delete_certificate and set_chuid.
+        transaction = self._transactions.get(transaction_id)
+        if transaction is None or transaction.closed:
+            self._transactions.pop(transaction_id, None)
+            return failure('no_transaction')
+
+        results = []
+        for step in steps:
+            args = dict(step)
+            op = args.pop('op', None)
+            handler = PIV_TRANSACTION_STEPS.get(op)
+            if handler is None:
+                result = failure('unknown_operation', {'op': op})
+            else:
+                # The transaction holds the device until it is closed, the
+                # state is invalidated before anyone else can read it.
+                slots = (args['slot'],) if 'slot' in args else ()
+                try:
+                    result = transaction.call(
+                        getattr(self, handler), transaction, **args)
+                except Exception as e:
+                    logger.debug('Transaction step %s failed', op,
+                                 exc_info=e)
+                    result = {
+                        'success': False,
+                        'error_id': None,
+                        'error_message': str(e),
+                    }
+                finally:
+                    self._piv_invalidate(
+                        transaction.serial, ('pin_tries',), slots)
+            results.append(dict(result, op=op))
+            if not result['success']:
+                return failure('step_failed', {'results': results})
+        return success({'results': results})
+
+    def piv_transaction_commit(self, transaction_id):
+        return self._piv_transaction_close(transaction_id)
+
+    def piv_transaction_abort(self, transaction_id):
+        # Steps already executed are not undone.
+        return self._piv_transaction_close(transaction_id)
+
+    def _piv_transaction_close(self, transaction_id):
+        # The session is closed instead of being returned to the pool, so
+        # that the authentication does not outlive the transaction.
+        transaction = self._transactions.pop(transaction_id, None)
+        if transaction is None:
+            return failure('no_transaction')
+        transaction.close(discard=True)
+        return success()
+
+    def _piv_transaction_closed(self, transaction):
+        # Also called for transactions that timed out.
+        self._transactions.pop(transaction.id, None)
+
+    def _piv_transaction_authenticate(self, controller, pin, mgm_key_hex):
+        # With a protected management key verifying the PIN authenticates.
+        auth_failed = self._piv_ensure_authenticated(
+            controller, pin, mgm_key_hex)
+        if auth_failed or controller.has_protected_key or not pin:
+            return auth_failed
+        return self._piv_verify_pin(controller, pin)
+
+    def _piv_step_generate(self, controller, transaction, slot, algorithm):
+        from ykman.piv import ALGO, SLOT
+        transaction.public_keys[slot] = controller.generate_key(
+            SLOT[slot], ALGO[algorithm])
+        return success()
+
+    def _piv_step_sign(self, controller, transaction, slot, sign):
+        from ykman.driver_ccid import APDUError, SW
+        from ykman.piv import SLOT
+        public_key = transaction.public_keys.get(slot)
+        if public_key is None:
+            return failure('no_generated_key', {'slot': slot})
+        # The signature slot requires the PIN for every use.
+        if SLOT[slot] == SLOT.SIGNATURE:
+            pin_failed = self._piv_verify_pin(controller, transaction.pin)
+            if pin_failed:
+                return pin_failed
+        try:
+            return sign(SLOT[slot], public_key)
+        except APDUError as e:
+            if e.sw == SW.SECURITY_CONDITION_NOT_SATISFIED:
+                return failure('pin_required')
+            raise
+
+    def _piv_step_self_sign(self, controller, transaction, slot, common_name,
+                            expiration_date):
+        valid_to = _parse_iso8601_date(expiration_date)
+        if valid_to is None:
+            return failure('invalid_iso8601_date', {'date': expiration_date})
+
+        def sign(piv_slot, public_key):
+            controller.generate_self_signed_certificate(
+                piv_slot, public_key, common_name,
+                datetime.datetime.utcnow(), valid_to)
+            return success()
+        return self._piv_step_sign(controller, transaction, slot, sign)
+
+    def _piv_step_csr(self, controller, transaction, slot, common_name,
+                      csr_file_url):
+        from cryptography.hazmat.primitives import serialization
+        file_path = self._get_file_path(csr_file_url)
+
+        def sign(piv_slot, public_key):
+            csr = controller.generate_certificate_signing_request(
+                piv_slot, public_key, common_name)
+            with open(file_path, 'w+b') as csr_file:
+                csr_file.write(csr.public_bytes(
+                    encoding=serialization.Encoding.PEM))
+            return success()
+        return self._piv_step_sign(controller, transaction, slot, sign)
+
+    def _piv_step_import(self, controller, transaction, slot, file_url,
+                         password=None):
+        from ykman.piv import SLOT
+        file_path = self._get_file_path(file_url)
+        try:
+            parsed = import_files.parse(
+                file_path, password.encode() if password else None)
+        except ValueError:
+            return failure('failed_parsing')
+        try:
+            if parsed.private_key is not None:
+                controller.import_key(SLOT[slot], parsed.private_key)
+            if parsed.certs:
+                controller.import_certificate(
+                    SLOT[slot], _piv_leaf_certificate(parsed.certs))
+        finally:
+            import_files.discard(file_path)
+        return success({
+            'imported_cert': bool(parsed.certs),
+            'imported_key': parsed.private_key is not None,
+        })
+
+    def _piv_step_delete_certificate(self, controller, transaction, slot):
+        from ykman.piv import SLOT
+        controller.delete_certificate(SLOT[slot])
+        return success()
+
+    def _piv_step_set_chuid(self, controller, transaction):
+        controller.update_chuid()
+        return success()
+
     def _get_file_path(self, file_url):
         file_path = urllib.parse.urlparse(file_url).path
         return file_path[1:] if os.name == 'nt' else file_path
 
     def _piv_verify_pin(self, piv_controller, pin=None):
+        from ykman.piv import (
+            AuthenticationBlocked, AuthenticationFailed, WrongPin)
         touch_required = False
 
         def touch_callback():
@@ -677,6 +2075,7 @@ class Controller(object):
 
     def _piv_ensure_authenticated(self, piv_controller, pin=None,
                                   mgm_key_hex=None):
+        from ykman.piv import AuthenticationFailed, BadFormat
         if piv_controller.has_protected_key:
             return self._piv_verify_pin(piv_controller, pin)
         else:
@@ -719,10 +2118,278 @@ class Controller(object):
                 return failure('mgm_key_required')
 
 
+class Request(object):
+
+    def __init__(self, request_id, method, args, lane, serial):
+        self.id = request_id
+        self.method = method
+        self.args = args
+        self.lane = lane
+        self.serial = serial
+        self.device = None
+
+
+class RequestExecutor(object):
+    # Runs Controller calls on worker threads and delivers each result as a
+    # callCompleted event, so a call waiting for touch does not hold up the
+    # bridge. Interactive requests run before background ones. Requests
+    # for the same device run one at a time, only the steps of an open PIV
+    # transaction, which holds the device, run next to them.
+
+    def __init__(self, controller, workers=EXECUTOR_WORKERS):
+        self._controller = controller
+        self._ids = itertools.count(1)
+        self._queue = []
+        self._busy = set()
+        self._closed = False
+        self._cond = threading.Condition()
+        for i in range(workers):
+            threading.Thread(
+                target=self._work, name='RequestWorker-%d' % i,
+                daemon=True).start()
+
+    def submit(self, method, args=(), lane='interactive', serial=None,
+               request_id=None):
+        if method.startswith('_') or not hasattr(self._controller, method):
+            raise ValueError('Unknown method: ' + method)
+        request = Request(
+            next(self._ids) if request_id is None else request_id,
+            method, list(args), LANES[lane], serial)
+        with self._cond:
+            self._queue.append(request)
+            self._cond.notify()
+        return request.id
+
+    def cancel(self, request_id):
+        # Only queued requests can be cancelled, a running one may already
+        # have talked to the device.
+        with self._cond:
+            for request in self._queue:
+                if request.id == request_id:
+                    self._queue.remove(request)
+                    break
+            else:
+                return False
+        _send('callCancelled', request_id)
+        return True
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            for request in self._queue:
+                _send('callCancelled', request.id)
+            self._queue = []
+            self._cond.notify_all()
+
+    def _device(self, request):
+        serial = request.serial
+        if serial is None:
+            serial = self._controller.selected_serial
+        if request.lane == LANES['transaction']:
+            return ('transaction', serial)
+        return serial
+
+    def _next(self):
+        ready = [r for r in self._queue
+                 if self._device(r) not in self._busy]
+        if not ready:
+            return None
+        request = min(ready, key=lambda r: (r.lane, r.id))
+        self._queue.remove(request)
+        request.device = self._device(request)
+        self._busy.add(request.device)
+        return request
+
+    def _work(self):
+        while True:
+            with self._cond:
+                request = self._next()
+                while request is None:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                    request = self._next()
+
+            kwargs = {}
+            if request.serial is not None:
+                kwargs['serial'] = request.serial
+            try:
+                method = getattr(self._controller, request.method)
+                result = method(*request.args, **kwargs)
+            except Exception as e:
+                logger.error('Uncaught exception', exc_info=e)
+                result = json.dumps(unknown_failure(e))
+            finally:
+                with self._cond:
+                    self._busy.discard(request.device)
+                    self._cond.notify_all()
+            _send('callCompleted', request.id, result)
+
+
+class DeviceWatcher(object):
+    # Blocks on PC/SC reader change notifications in a background thread and
+    # only enumerates USB devices when the set of readers changes. Keys
+    # without a CCID reader are still found by the polling in the UI.
+
+    def __init__(self, descriptors):
+        self._descriptors = descriptors
+        self._fingerprints = set()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.active:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='DeviceWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.active:
+            self._thread.join()
+
+    def _run(self):
+        from smartcard import scard
+        hresult, context = scard.SCardEstablishContext(scard.SCARD_SCOPE_USER)
+        if hresult != scard.SCARD_S_SUCCESS:
+            logger.debug('Hotplug monitor unavailable: %s',
+                         scard.SCardGetErrorMessage(hresult))
+            return
+
+        try:
+            states = [(PNP_NOTIFICATION, scard.SCARD_STATE_UNAWARE)]
+            _send('hotplugActive')
+            self._check_devices()
+            while not self._stopped.is_set():
+                hresult, changes = scard.SCardGetStatusChange(
+                    context, HOTPLUG_TIMEOUT_MS, states)
+                if hresult == scard.SCARD_E_TIMEOUT:
+                    continue
+                if hresult != scard.SCARD_S_SUCCESS:
+                    logger.debug('Hotplug monitor stopped: %s',
+                                 scard.SCardGetErrorMessage(hresult))
+                    break
+                if changes[0][1] & scard.SCARD_STATE_UNKNOWN:
+                    logger.debug('PC/SC does not support PnP notifications')
+                    break
+                states = [(reader, state) for reader, state, _ in changes]
+                self._check_devices()
+        except Exception as e:
+            logger.debug('Hotplug monitor failed', exc_info=e)
+        finally:
+            scard.SCardReleaseContext(context)
+            _send('hotplugInactive')
+
+    def _check_devices(self):
+        fingerprints = {
+            _fingerprint_id(d.fingerprint)
+            for d in self._descriptors.refresh()}
+        for fingerprint in fingerprints - self._fingerprints:
+            _send('deviceAdded', fingerprint)
+        for fingerprint in self._fingerprints - fingerprints:
+            _send('deviceRemoved', fingerprint)
+        self._fingerprints = fingerprints
+
+
 controller = None
+executor = None
+watcher = None
+cert_summaries = CertificateSummaryCache()
+import_files = ParsedFileCache()
+metrics = Metrics()
+_metrics_file = None
+uploader = None
+inventory = None
+_uploader_lock = threading.Lock()
+log_buffer = LogBuffer()
+_log_listener = None
+
+
+def _all_transports():
+    from ykman.util import TRANSPORT
+    return sum(TRANSPORT)
+
+
+def _open_drivers():
+    from ykman.driver_ccid import open_devices as open_ccid
+    from ykman.driver_fido import open_devices as open_fido
+    from ykman.driver_otp import open_devices as open_otp
+    for open_devices in (open_ccid, open_otp, open_fido):
+        for driver in open_devices():
+            if driver:
+                yield driver
+
+
+def _open_yubikey(driver):
+    from ykman.descriptor import Descriptor
+    from ykman.device import YubiKey
+    try:
+        return YubiKey(Descriptor.from_driver(driver), driver)
+    except Exception as e:
+        logger.debug('Failed to read device on %s', driver, exc_info=e)
+        driver.close()
+
+
+def _device_info(dev):
+    from ykman.util import APPLICATION, TRANSPORT
+    return {
+        'name': dev.device_name,
+        'version': '.'.join(str(x) for x in dev.version),
+        'serial': dev.serial or '',
+        'usb_enabled': [
+            a.name for a in APPLICATION
+            if a & dev.config.usb_enabled],
+        'usb_supported': [
+            a.name for a in APPLICATION
+            if a & dev.config.usb_supported],
+        'usb_interfaces_supported': [
+            t.name for t in TRANSPORT
+            if t & dev.config.usb_supported],
+        'nfc_enabled': [
+            a.name for a in APPLICATION
+            if a & dev.config.nfc_enabled],
+        'nfc_supported': [
+            a.name for a in APPLICATION
+            if a & dev.config.nfc_supported],
+        'usb_interfaces_enabled': str(dev.mode).split('+'),
+        'can_write_config': dev.can_write_config,
+        'configuration_locked': dev.config.configuration_locked,
+        'form_factor': dev.config.form_factor
+    }
+
+
+def _fingerprint_id(fingerprint):
+    return hashlib.sha1(repr(fingerprint).encode()).hexdigest()[:16]
+
+
+def _inventory_fingerprint(fingerprint):
+    # USB descriptors are fingerprinted by (pid, version, bus, address,
+    # serial string index). The bus and address change every time the key
+    # is plugged in, they are left out of the fingerprint the inventory
+    # keeps.
+    if len(fingerprint) == 5:
+        pid, version, _, _, serial_index = fingerprint
+        fingerprint = (pid, version, serial_index)
+    return _fingerprint_id(fingerprint)
 
 
 def _piv_serialise_cert(slot, cert):
+    from ykman.piv import SLOT
+    if cert:
+        summary = cert_summaries.get(cert)
+    else:
+        summary = _piv_cert_summary(None)
+    return dict(summary, slot=SLOT(slot).name)
+
+
+def _piv_cert_summary(cert):
+    from cryptography import x509
     if cert:
         # Try reading out issuer and subject,
         # may throw ValueError if malformed
@@ -755,7 +2422,6 @@ def _piv_serialise_cert(slot, cert):
         valid_to = None
 
     return {
-        'slot': SLOT(slot).name,
         'malformed': malformed,
         'issuedFrom': issuer_cns[0].value if issuer_cns else '',
         'issuedTo': subject_cns[0].value if subject_cns else '',
@@ -764,21 +2430,243 @@ def _piv_serialise_cert(slot, cert):
     }
 
 
+def _parse_import_file(data, password=None):
+    # Returns a ParsedFile, or the ValueError to raise if nothing could be
+    # parsed, so that failures are cached as well.
+    from ykman.util import is_pkcs12, parse_certificates, parse_private_key
+    if b'-----BEGIN' in data:
+        kind = 'pem'
+    elif is_pkcs12(data):
+        kind = 'pkcs12'
+    else:
+        kind = 'der'
+
+    certs = []
+    private_keys = []
+    if kind == 'pkcs12':
+        # One decryption for everything, the PKCS#12 KDF is slow. The
+        # certificate of the key comes first, the others may be its chain
+        # or identities whose keys are not read.
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.serialization import pkcs12
+        try:
+            key, cert, extra_certs = pkcs12.load_key_and_certificates(
+                data, password, default_backend())
+        except (ValueError, TypeError) as e:
+            return ValueError(e)
+        certs = ([cert] if cert is not None else []) + list(extra_certs)
+        if key is not None:
+            private_keys = [key]
+    else:
+        try:
+            certs = parse_certificates(data, password)
+        except (ValueError, TypeError):
+            pass
+        # A PEM bundle may hold keys for several slots.
+        blocks = [m.group(0) for m in _PEM_PRIVATE_KEY.finditer(data)] \
+            if kind == 'pem' else [data]
+        for block in blocks:
+            try:
+                private_keys.append(parse_private_key(block, password))
+            except (ValueError, TypeError):
+                pass
+
+    if not certs and not private_keys:
+        return ValueError('Failed to parse certificate or key')
+    return ParsedFile(kind, certs, private_keys)
+
+
+_PEM_PRIVATE_KEY = re.compile(
+    rb'-----BEGIN ([A-Z ]*)PRIVATE KEY-----.*?-----END \1PRIVATE KEY-----',
+    re.DOTALL)
+
+
+def _parse_iso8601_date(date):
+    try:
+        return datetime.datetime(
+            int(date[0:4]), int(date[5:7]), int(date[8:10]))
+    except ValueError as e:
+        logger.debug('Failed to parse date: ' + date, exc_info=e)
+        return None
+
+
+def _piv_leaf_certificate(certs):
+    from ykman.util import get_leaf_certificates
+    if len(certs) > 1:
+        return get_leaf_certificates(certs)[0]
+    return certs[0] if certs else None
+
+
+def _piv_bundle_identities(parsed):
+    # Pairs every private key in a bundle with its certificate, a key
+    # without one is imported alone. Without keys every leaf certificate
+    # is an identity of its own. Returns the identities, and the leaf
+    # certificates left without their key, which are not imported.
+    from cryptography.hazmat.primitives import serialization
+    from ykman.util import get_leaf_certificates
+
+    def public_bytes(key):
+        return key.public_bytes(
+            serialization.Encoding.DER,
+            serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    if not parsed.private_keys:
+        return [(cert, None)
+                for cert in get_leaf_certificates(parsed.certs)], []
+    certs = {public_bytes(cert.public_key()): cert for cert in parsed.certs}
+    identities = [(certs.get(public_bytes(key.public_key())), key)
+                  for key in parsed.private_keys]
+    paired = {id(cert) for cert, _ in identities}
+    skipped = [cert for cert in get_leaf_certificates(parsed.certs)
+               if id(cert) not in paired]
+    return identities, skipped
+
+
+def _send(event, *args):
+    if pyotherside is not None:
+        pyotherside.send(event, *args)
+
+
+def _piv_cert_slots():
+    from ykman.piv import SLOT
+    # The slots shown in the UI first, then the retired key slots.
+    return sorted(
+        set(SLOT) - {SLOT.CARD_MANAGEMENT, SLOT.ATTESTATION},
+        key=lambda slot: (slot < SLOT.AUTHENTICATION, slot))
+
+
+def _piv_slot_occupied(driver, slot):
+    # Only the status word of the first response is needed, the rest of
+    # the object is never fetched.
+    from ykman.driver_ccid import SW
+    from ykman.util import Tlv
+    from ykman.piv import INS, OBJ, TAG
+    object_id = struct.pack(b'>I', OBJ.from_slot(slot)).lstrip(b'\0')
+    _, sw = driver.send_apdu(
+        0, INS.GET_DATA, 0x3f, 0xff, Tlv(TAG.OBJ_ID, object_id),
+        check=None)
+    return sw == SW.OK or (sw >> 8) == SW.MORE_DATA
+
+
+def _piv_pending_cert(slot):
+    return {
+        'slot': slot.name,
+        'malformed': False,
+        'issuedFrom': '',
+        'issuedTo': '',
+        'validFrom': '',
+        'validTo': '',
+        'pending': True,
+    }
+
+
 def _touch_prompt():
-    pyotherside.send('touchRequired')
+    _send('touchRequired')
 
 
 def _close_touch_prompt():
-    pyotherside.send('touchNotRequired')
+    _send('touchNotRequired')
+
+
+def _dump_metrics():
+    if _metrics_file:
+        metrics.dump(_metrics_file)
+
+
+def setup_logging(log_level, log_file=None):
+    # Sets up logging like ykman does, then moves the handlers behind a
+    # queue, so that logging while talking to a device never waits on the
+    # log file. Records are also kept in log_buffer.
+    global _log_listener
+    ykman.logging_setup.setup(log_level, log_file)
+    if _log_listener is not None:
+        return
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+    if handlers:
+        log_buffer.setFormatter(handlers[0].formatter)
+    log_buffer.dump_path = os.environ.get(LOG_DUMP_ENV)
+    records = queue.Queue()
+    _log_listener = logging.handlers.QueueListener(
+        records, log_buffer, *handlers, respect_handler_level=True)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    _log_listener.start()
+    # Stopping writes out what is still queued.
+    atexit.register(_log_listener.stop)
 
 
 def init_with_logging(log_level, log_file=None):
-    logging_setup = as_json(ykman.logging_setup.setup)
-    logging_setup(log_level, log_file)
+    setup_logging(log_level, log_file)
 
     init()
 
 
-def init():
-    global controller
-    controller = Controller()
+def _load_backend(backend=None):
+    # Either a backend object, or the name of one: 'hardware' (default) or
+    # 'simulated'. The simulated backend is set up from the environment,
+    # see simulated.py.
+    backend = backend or os.environ.get(BACKEND_ENV) or 'hardware'
+    if backend == 'hardware':
+        return HardwareBackend()
+    if backend == 'simulated':
+        import simulated
+        return simulated.from_environment()
+    if isinstance(backend, str):
+        raise ValueError('Unknown backend: ' + backend)
+    return backend
+
+
+def _load_inventory():
+    # The inventory is only a cache, the backend works without it.
+    global inventory
+    if inventory is None and os.environ.get(INVENTORY_ENV):
+        import inventory as inventory_module
+        try:
+            inventory = inventory_module.from_environment()
+        except Exception as e:
+            logger.warning('Failed to open the device inventory',
+                           exc_info=e)
+    return inventory
+
+
+def _load_uploader():
+    # Set up on first use, or on init if uploads are left in the spool
+    # from an earlier run, which are started right away.
+    global uploader
+    with _uploader_lock:
+        if uploader is None:
+            import upload
+            uploader = upload.from_environment(
+                on_change=lambda record: _send('uploadChanged', record))
+            if uploader.pending():
+                uploader.start()
+        return uploader
+
+
+def init(descriptor_ttl=DESCRIPTOR_TTL, session_timeout=SESSION_IDLE_TIMEOUT,
+         cert_cache_size=CERT_CACHE_SIZE, metrics_file=None, backend=None):
+    global controller, executor, watcher, _metrics_file
+    backend = _load_backend(backend)
+    metrics_file = metrics_file or os.environ.get(METRICS_FILE_ENV)
+    if metrics_file and _metrics_file is None:
+        atexit.register(_dump_metrics)
+    _metrics_file = metrics_file or _metrics_file
+    cert_summaries.maxsize = cert_cache_size
+    descriptors = DescriptorCache(descriptor_ttl, backend)
+    controller = Controller(
+        descriptors, SessionPool(session_timeout), backend,
+        inventory=_load_inventory())
+    if executor is not None:
+        executor.shutdown()
+    executor = RequestExecutor(controller)
+    if watcher is not None:
+        watcher.stop()
+        watcher = None
+    if backend.hotplug:
+        watcher = DeviceWatcher(descriptors)
+        watcher.start()
+    import upload
+    if upload.has_pending():
+        _load_uploader()
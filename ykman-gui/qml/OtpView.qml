@@ -16,7 +16,7 @@ ColumnLayout {
 
     function load() {
         isBusy = true
-        yubiKey.slotsStatus(function (resp) {
+        yubiKey.refreshOtp(function (resp) {
             if (resp.success) {
                 views.slot1Configured = resp.status[0]
                 views.slot2Configured = resp.status[1]
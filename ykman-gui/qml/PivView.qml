@@ -26,10 +26,13 @@ ColumnLayout {
                     isMacOs = resp.is_macos
                 }
             })
-        })
+        }, true)
     }
 
     function getNumberOfCertsMessage() {
+        if (yubiKey.pivCertificatesLoading) {
+            return qsTr("Loading certificates...")
+        }
         var numberOfCerts = yubiKey.numberOfPivCertificates()
         if (numberOfCerts > 0) {
             return numberOfCerts + qsTr(" certificates loaded")
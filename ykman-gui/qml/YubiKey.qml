@@ -25,9 +25,16 @@ Python {
 
     property bool yubikeyModuleLoaded: false
     property bool yubikeyReady: false
+    property bool hotplugActive: false
     property var queue: []
+    property var pendingCalls: ({})
+    property int nextCallId: 1
+    property bool refreshPending: false
+    property var devGeneration: null
     property var piv
+    property var otp
     property bool pivPukBlocked: false
+    property bool pivCertificatesLoading: false
 
     property int formFactor
 
@@ -53,8 +60,10 @@ Python {
 
                                     }
 
+    signal devicesChanged
     signal enableLogging(string logLevel, string logFile)
     signal disableLogging
+    signal uploadChanged(var upload)
 
     onReceived: {
         switch (data[0]) {
@@ -64,6 +73,34 @@ Python {
         case 'touchNotRequired':
             touchYubiKey.close()
             break
+        case 'hotplugActive':
+            hotplugActive = true
+            break
+        case 'hotplugInactive':
+            hotplugActive = false
+            break
+        case 'pivCertificate':
+            updatePivCertificate(data[1], data[2])
+            break
+        case 'pivCertificatesLoaded':
+            pivCertificatesLoading = false
+            break
+        case 'deviceAdded':
+        case 'deviceRemoved':
+            devicesChanged()
+            break
+        case 'uploadChanged':
+            uploadChanged(data[1])
+            break
+        case 'callCompleted':
+            completeAsyncCall(data[1], data[2])
+            break
+        case 'callCancelled':
+            completeAsyncCall(data[1], JSON.stringify({
+                                                          success: false,
+                                                          error_id: 'cancelled'
+                                                      }))
+            break
         default:
             console.log('Recevied event:', data)
         }
@@ -94,7 +131,10 @@ Python {
     }
 
     onYubikeyModuleLoadedChanged: runQueue()
-    onYubikeyReadyChanged: runQueue()
+    onYubikeyReadyChanged: {
+        loadCachedDeviceInfo()
+        runQueue()
+    }
 
     function clearYubiKey() {
         hasDevice = false
@@ -108,6 +148,8 @@ Python {
         applicationsEnabledOverUsb = []
         applicationsSupportedOverNfc = []
         applicationsEnabledOverNfc = []
+        otp = undefined
+        devGeneration = null
     }
 
     function isPythonReady(funcName) {
@@ -138,6 +180,42 @@ Python {
         }
     }
 
+    /**
+     * Run a Controller method on the backend worker threads.
+     *
+     * The bridge stays free while the call runs, so a call waiting for
+     * touch does not hold up other calls.
+     *
+     * @param method the name of the Controller method
+     * @param args the arguments to the method
+     * @param cb a function called with the response, the error_id is
+     *      'cancelled' if the call was cancelled before it ran
+     * @param lane 'interactive' (default), 'background' or 'transaction'
+     *      for the steps of an open PIV transaction, which run first
+     * @return an id that can be passed to cancelAsyncCall
+     */
+    function doAsyncCall(method, args, cb, lane) {
+        // The id is picked here, the result may arrive before the call to
+        // submit has returned.
+        var callId = nextCallId++
+        pendingCalls[callId] = cb
+        doCall('yubikey.executor.submit',
+               [method, args, lane || 'interactive', null, callId])
+        return callId
+    }
+
+    function cancelAsyncCall(callId) {
+        doCall('yubikey.executor.cancel', [callId])
+    }
+
+    function completeAsyncCall(callId, json) {
+        var cb = pendingCalls[callId]
+        delete pendingCalls[callId]
+        if (cb) {
+            cb(json ? JSON.parse(json) : undefined)
+        }
+    }
+
     function doPivCall(func, args, cb) {
         return doCall(func, args, _refreshPivBefore(cb))
     }
@@ -263,47 +341,104 @@ Python {
     }
 
     function refresh(doneCallback) {
-        doCall('yubikey.controller.count_devices', [], function (n) {
-            nDevices = n
-            if (nDevices == 1) {
-                doCall('yubikey.controller.refresh', [], function (resp) {
-                    if (resp.success && resp.dev) {
-                        hasDevice = true
-                        name = resp.dev.name
-                        version = resp.dev.version
-                        serial = resp.dev.serial
-                        configurationLocked = resp.dev.configuration_locked
-                        applicationsSupportedOverUsb = resp.dev.usb_supported
-                        applicationsEnabledOverUsb = resp.dev.usb_enabled
-                        applicationsSupportedOverNfc = resp.dev.nfc_supported
-                        applicationsEnabledOverNfc = resp.dev.nfc_enabled
-                        usbInterfacesSupported = resp.dev.usb_interfaces_supported
-                        usbInterfacesEnabled = resp.dev.usb_interfaces_enabled
-                        canWriteConfig = resp.dev.can_write_config
-                        formFactor = resp.dev.form_factor
-                    } else {
-                        clearYubiKey()
-                    }
-
-                    if (doneCallback) {
-                        doneCallback(resp)
-                    }
-
-                })
-
+        if (refreshPending) {
+            return
+        }
+        refreshPending = true
+        doAsyncCall('snapshot', [devGeneration], function (resp) {
+            refreshPending = false
+            if (resp.error_id === 'cancelled') {
+                return
+            }
+            if (nDevices !== (resp.n_devices || 0)) {
+                nDevices = resp.n_devices || 0
+            }
+            if (resp.success && resp.generation) {
+                hasDevice = true
+                devGeneration = resp.generation
+                // Only the keys that changed since the last refresh are
+                // sent, nothing if 'not_modified' is set.
+                applyDeviceInfo(resp.dev || resp.changes || {})
             } else if (hasDevice) {
                 clearYubiKey()
             }
 
+            if (doneCallback) {
+                doneCallback(resp)
+            }
+        }, 'background')
+    }
+
+    function loadCachedDeviceInfo() {
+        // Show what is remembered of the key until the first refresh has
+        // read it.
+        doCall('yubikey.controller.cached_snapshot', [], function (resp) {
+            if (resp.success && devGeneration === null) {
+                nDevices = resp.n_devices
+                hasDevice = true
+                applyDeviceInfo(resp.dev)
+            }
         })
     }
 
-    function refreshPivData(doneCallback) {
+    function applyDeviceInfo(dev) {
+        if (dev.hasOwnProperty('name')) {
+            name = dev.name
+        }
+        if (dev.hasOwnProperty('version')) {
+            version = dev.version
+        }
+        if (dev.hasOwnProperty('serial')) {
+            serial = dev.serial
+        }
+        if (dev.hasOwnProperty('configuration_locked')) {
+            configurationLocked = dev.configuration_locked
+        }
+        if (dev.hasOwnProperty('usb_supported')) {
+            applicationsSupportedOverUsb = dev.usb_supported
+        }
+        if (dev.hasOwnProperty('usb_enabled')) {
+            applicationsEnabledOverUsb = dev.usb_enabled
+        }
+        if (dev.hasOwnProperty('nfc_supported')) {
+            applicationsSupportedOverNfc = dev.nfc_supported
+        }
+        if (dev.hasOwnProperty('nfc_enabled')) {
+            applicationsEnabledOverNfc = dev.nfc_enabled
+        }
+        if (dev.hasOwnProperty('usb_interfaces_supported')) {
+            usbInterfacesSupported = dev.usb_interfaces_supported
+        }
+        if (dev.hasOwnProperty('usb_interfaces_enabled')) {
+            usbInterfacesEnabled = dev.usb_interfaces_enabled
+        }
+        if (dev.hasOwnProperty('can_write_config')) {
+            canWriteConfig = dev.can_write_config
+        }
+        if (dev.hasOwnProperty('form_factor')) {
+            formFactor = dev.form_factor
+        }
+    }
+
+    /**
+     * Refresh `piv` from the YubiKey.
+     *
+     * @param doneCallback a function called with the response
+     * @param lazy if true, only find out which slots are in use before
+     *      calling `doneCallback`. The certificates are then filled in as
+     *      they are read.
+     */
+    function refreshPivData(doneCallback, lazy) {
         if (hasDevice) {
-            doCall('yubikey.controller.refresh_piv', [], function (resp) {
-                if (resp.success) {
+            doCall('yubikey.controller.refresh_piv', [null, !!lazy], function (resp) {
+                // Only reassign when something changed to avoid needless
+                // re-evaluation of bindings on the PIV views.
+                if (resp.success && (!piv || resp.changed.length > 0)) {
                     piv = resp.piv_data
                 }
+                if (resp.success) {
+                    pivCertificatesLoading = resp.pending_slots.length > 0
+                }
                 if (doneCallback) {
                     doneCallback(resp)
                 }
@@ -318,6 +453,20 @@ Python {
         }
     }
 
+    function updatePivCertificate(slotId, certificate) {
+        if (piv) {
+            var certs = Utils.extend(piv.certs, {})
+            if (certificate) {
+                certs[slotId] = certificate
+            } else {
+                delete certs[slotId]
+            }
+            piv = Utils.extend(piv, {
+                                   certs: certs
+                               })
+        }
+    }
+
     /**
      * Transform a `callback` into one that will first call `refreshPivData`
      * and then itself when `refresh` is done.
@@ -360,6 +509,22 @@ Python {
         doCall('yubikey.controller.slots_status', [], cb)
     }
 
+    /**
+     * Refresh `otp` from the YubiKey: the slot status, the public ID derived
+     * from the serial and random candidates for the private ID and keys,
+     * which randomUid and randomKey hand out before calling the backend.
+     */
+    function refreshOtp(cb) {
+        doCall('yubikey.controller.refresh_otp', [], function (resp) {
+            if (resp.success) {
+                otp = resp
+            }
+            if (cb) {
+                cb(resp)
+            }
+        })
+    }
+
     function eraseSlot(slot, cb) {
         doCall('yubikey.controller.erase_slot', [slot], cb)
     }
@@ -369,15 +534,32 @@ Python {
     }
 
     function serialModhex(cb) {
-        doCall('yubikey.controller.serial_modhex', [], cb)
+        if (otp && otp.serial_modhex) {
+            cb(otp.serial_modhex)
+        } else {
+            doCall('yubikey.controller.serial_modhex', [], cb)
+        }
     }
 
     function randomUid(cb) {
-        doCall('yubikey.controller.random_uid', [], cb)
+        // Each candidate is only handed out once.
+        if (otp && otp.candidates.uid) {
+            var uid = otp.candidates.uid
+            delete otp.candidates.uid
+            cb(uid)
+        } else {
+            doCall('yubikey.controller.random_uid', [], cb)
+        }
     }
 
     function randomKey(bytes, cb) {
-        doCall('yubikey.controller.random_key', [bytes], cb)
+        if (otp && otp.candidates.keys[bytes]) {
+            var key = otp.candidates.keys[bytes]
+            delete otp.candidates.keys[bytes]
+            cb(key)
+        } else {
+            doCall('yubikey.controller.random_key', [bytes], cb)
+        }
     }
 
     function generateStaticPw(keyboardLayout, cb) {
@@ -389,6 +571,10 @@ Python {
                [slot, publicId, privateId, key, upload, appVersion], cb)
     }
 
+    function yubicloudUploads(cb) {
+        doCall('yubikey.controller.yubicloud_uploads', [], cb)
+    }
+
     function programChallengeResponse(slot, key, touch, cb) {
         doCall('yubikey.controller.program_challenge_response',
                [slot, key, touch], cb)
@@ -416,7 +602,7 @@ Python {
     }
 
     function fidoReset(cb) {
-        doCall('yubikey.controller.fido_reset', [], cb)
+        doAsyncCall('fido_reset', [], cb)
     }
 
     function fidoPinRetries(cb) {
@@ -498,13 +684,37 @@ Python {
     }
 
     function pivGenerateCertificate(args) {
-        doPivCall('yubikey.controller.piv_generate_certificate',
-                  [args.slotName, args.algorithm, args.commonName, args.expirationDate, !!args.selfSign, args.csrFileUrl, args.pin, args.keyHex],
-                  args.callback)
+        doAsyncCall('piv_generate_certificate',
+                    [args.slotName, args.algorithm, args.commonName, args.expirationDate, !!args.selfSign, args.csrFileUrl, args.pin, args.keyHex],
+                    _refreshPivBefore(args.callback))
     }
 
     function pivExportCertificate(slot, fileUrl, cb) {
         doPivCall('yubikey.controller.piv_export_certificate',
                   [slot, fileUrl], cb)
     }
+
+    function pivExportCertificates(fileUrl, perSlot, allDevices, cb) {
+        doCall('yubikey.controller.piv_export_certificates',
+               [fileUrl, !!perSlot, !!allDevices], cb)
+    }
+
+    function pivTransactionBegin(pin, keyHex, cb) {
+        doAsyncCall('piv_transaction_begin', [pin, keyHex], cb)
+    }
+
+    function pivTransactionExecute(transactionId, steps, cb) {
+        doAsyncCall('piv_transaction_execute', [transactionId, steps], cb,
+                    'transaction')
+    }
+
+    function pivTransactionCommit(transactionId, cb) {
+        doAsyncCall('piv_transaction_commit', [transactionId],
+                    _refreshPivBefore(cb), 'transaction')
+    }
+
+    function pivTransactionAbort(transactionId, cb) {
+        doAsyncCall('piv_transaction_abort', [transactionId],
+                    _refreshPivBefore(cb), 'transaction')
+    }
 }
@@ -107,6 +107,7 @@ ApplicationWindow {
         id: yubiKey
         onError: console.log(traceback)
         onHasDeviceChanged: hasDevice ? yubiKeyInserted() : yubiKeyRemoved()
+        onDevicesChanged: poller.restart()
         onNDevicesChanged: {
             // Special fix for solving > 1 keys inserted at launch.
             if (!hasDevice && (yubiKey.nDevices > 1)) {
@@ -115,10 +116,12 @@ ApplicationWindow {
         }
     }
 
+    // Insertions and removals are pushed by the hotplug watcher when it is
+    // running, polling is then only a fallback for keys without CCID.
     Timer {
         id: poller
         triggeredOnStart: true
-        interval: 500
+        interval: yubiKey.hotplugActive ? 3000 : 500
         repeat: true
         running: true
         onTriggered: yubiKey.refresh(function (resp) {
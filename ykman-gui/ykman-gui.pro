@@ -63,4 +63,7 @@ lupdate_only {
 }
 
 DISTFILES += \
-    py/yubikey.py
+    py/yubikey.py \
+    py/simulated.py \
+    py/upload.py \
+    py/inventory.py